@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+## Microbenchmarks of the code that runs per line or per message. Every
+## benchmark works through a fixed, seeded dataset. Timings are the best of
+## a number of repeats with the garbage collector off, in ns per operation.
+##
+## Regression mode: save a baseline once, later runs compared against it
+## fail (exit 1) when any benchmark got slower than threshold times the
+## baseline.
+##   bench/micro.py --save base.json
+##   bench/micro.py --baseline base.json --threshold 1.5
+
+import os, sys, asyncio, gc, json, random, functools, traceback, importlib.util
+import argparse
+import logging as log
+from configparser import ConfigParser
+from time import perf_counter
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+import cncd, handlers, robot, flavour, gcodestate, pluginmanager
+from pluginmanager import PluginManager, plugin_hook
+from datastore import DataStore
+from throughput import workload
+from plugins.trace import Subscription
+
+## size of the datasets, operations per repeat
+DATASET = 2000
+
+def load_plugin(name, datastore, gctx):
+    path = os.path.join(ROOT, 'plugins', name + '.py')
+    spec = importlib.util.spec_from_file_location("module.name", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Plugin(datastore, gctx)
+
+def new_gctx():
+    loop = asyncio.get_event_loop()
+    cfg = ConfigParser()
+    cfg.read_dict({'general': {}})
+    return {'loop': loop, 'cfg': cfg, 'dev': {}, 'plugins': [],
+        'datastore': DataStore()}
+
+def responses(rnd):
+    """ What a printer sends: mostly acks, some temperatures """
+    lines = []
+    for _ in range(DATASET):
+        r = rnd.random()
+        if r < .8:
+            lines.append('ok\n')
+        elif r < .95:
+            lines.append('ok T:{:.2f} /210.00 B:{:.2f} /60.00 @:64 B@:0\n'.format(
+                rnd.uniform(200, 215), rnd.uniform(55, 62)))
+        else:
+            lines.append('echo:busy: processing\n')
+    return lines
+
+class NullTransport:
+    def write(self, data): pass
+    def is_closing(self): return False
+    def get_write_buffer_size(self): return 0
+
+## Benchmarks. Each takes the parsed arguments and returns (op, items): op
+## is called once per item, it may be a coroutine function.
+
+BENCHMARKS = {}
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+@benchmark
+def command(args):
+    """ cncd.command: shlex, handler scan and task creation """
+    gctx = new_gctx()
+    gctx['hdl'] = [cncd.Handler(h.__name__, h) for h in handlers.handlers]
+    ## plugin handlers are scanned as well
+    gctx['hdl'] += [cncd.Handler(name, handlers.last_resort)
+        for name in ('data', 'progress', 'subscribe', 'unsubscribe', 'actions', 'gcode')]
+    cctx = {'uid': 0, 'transport': NullTransport(), 'write_max': 1<<20}
+    cmds = ['{} data dev{}'.format(i, i % 4) if i % 3 else '{} metrics "dev {}"'.format(i, i % 4)
+        for i in range(DATASET)]
+    async def op(line):
+        cncd.command(line, gctx, cctx)
+    return op, cmds
+
+class HookTarget:
+    @plugin_hook
+    async def target(self, line):
+        return line
+
+def legacy_plugin_hook(func):
+    """ plugin_hook as it was before the call chains were compiled: hooks
+        looked up and logged on every call, the baseline of hook_* """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        qname = func.__qualname__
+        module = func.__module__
+        prehooks, posthooks = pluginmanager.pluginmanager.hooks_for(module, qname)
+        for hook in prehooks:
+            if not hook.callback: continue
+            log.debug("Function {} was pre hooked by {}".format(qname, hook.plugin.NAME))
+            try:
+                await hook.callback(*args, **kwargs)
+            except Exception as e:
+                log.error(traceback.format_exc())
+        r = await func(*args, **kwargs)
+        for hook in posthooks:
+            if not hook.callback: continue
+            log.debug("Function {} was post hooked by {}".format(qname, hook.plugin.NAME))
+            try:
+                await hook.callback(*args, **kwargs)
+            except Exception as e:
+                log.error(traceback.format_exc())
+        return r
+    return wrapper
+
+class LegacyHookTarget:
+    async def target(self, line):
+        return line
+    ## same hooks as HookTarget.target
+    target.__qualname__ = 'HookTarget.target'
+    target = legacy_plugin_hook(target)
+
+class HookPlugin:
+    NAME = "bench"
+    PREHOOKS = {}
+    POSTHOOKS = {}
+    EVENTS = {}
+    ## never drops, nothing is consumed while timing
+    EVENT_QUEUE_SIZE = 1<<30
+    EVENT_POLICY = 'drop'
+    async def hook(self, *args):
+        pass
+
+def hooked(posthooks, events):
+    manager = PluginManager(new_gctx())
+    plugin = HookPlugin()
+    HookPlugin.POSTHOOKS = posthooks(plugin)
+    HookPlugin.EVENTS = events(plugin)
+    manager.collect_hooks(plugin)
+    manager.compile_hooks()
+    target = HookTarget()
+    return target.target, ['G1 X1 Y1 E1'] * DATASET
+
+def legacy_hooked(posthooks):
+    hooked(posthooks, lambda p: {})
+    return LegacyHookTarget().target, ['G1 X1 Y1 E1'] * DATASET
+
+@benchmark
+def hook_unhooked(args):
+    """ plugin_hook target without hooks """
+    return hooked(lambda p: {}, lambda p: {})
+
+@benchmark
+def hook_legacy_unhooked(args):
+    """ hook_unhooked with the wrapper of before compile_hooks """
+    return legacy_hooked(lambda p: {})
+
+@benchmark
+def hook_post(args):
+    """ plugin_hook target with one post hook """
+    return hooked(lambda p: {(__name__, 'HookTarget.target'): [p.hook]}, lambda p: {})
+
+@benchmark
+def hook_legacy_post(args):
+    """ hook_post with the wrapper of before compile_hooks """
+    return legacy_hooked(lambda p: {(__name__, 'HookTarget.target'): [p.hook]})
+
+@benchmark
+def hook_event(args):
+    """ plugin_hook target publishing one event """
+    return hooked(lambda p: {}, lambda p: {(__name__, 'HookTarget.target'): [p.hook]})
+
+def subscriber_lctx(n, transport):
+    """ Writes like cncd's for a client command with nonce n """
+    prefix = "{} ".format(n).encode()
+    def write_encoded(line):
+        transport.write(prefix + line)
+    def write_json(msg):
+        write_encoded((json.dumps(msg) + '\n').encode())
+    return cncd.Lctx(n, None, ['subscribe', 'dev0'], write_json, None, write_encoded)
+
+def trace_plugin(args, interval=0):
+    store = DataStore()
+    plugin = load_plugin('trace', store, new_gctx())
+    transport = NullTransport()
+    writable = asyncio.Event()
+    writable.set()
+    for n in range(args.subscribers):
+        plugin.subscriptions[(n, 'dev0')] = Subscription('dev0', [],
+            subscriber_lctx(n, transport), interval, store, plugin.synced, writable)
+    rnd = random.Random(args.seed)
+    updates = [('dev0', rnd.choice(('progress', 'current_z', 'temperature')), rnd.random())
+        for _ in range(DATASET)]
+    return store, plugin, updates
+
+@benchmark
+def trace_fanout(args):
+    """ trace plugin delivering one DataStore.update to N subscribers """
+    store, plugin, updates = trace_plugin(args)
+    async def op(update):
+        await plugin.update(store, *update)
+    return op, updates
+
+@benchmark
+def trace_coalesce(args):
+    """ trace plugin collecting one DataStore.update for N subscribers
+        that receive changes once per interval """
+    store, plugin, updates = trace_plugin(args, interval=1)
+    async def op(update):
+        await plugin.update(store, *update)
+    return op, updates
+
+@benchmark
+def datastore_update(args):
+    """ DataStore.update with the trace plugin hooked, the caller's cost """
+    store, plugin, updates = trace_plugin(args)
+    manager = PluginManager(new_gctx())
+    manager.collect_hooks(plugin)
+    manager.compile_hooks()
+    async def op(update):
+        await store.update(*update)
+    return op, updates
+
+@benchmark
+def data_received(args):
+    """ CncConnection.data_received splitting serial data in lines """
+    class Device:
+        def set_protocol(self, proto): pass
+    data = ''.join(responses(random.Random(args.seed))).encode()
+    ## serial data arrives in arbitrary pieces
+    chunks = [data[i:i+64] for i in range(0, len(data), 64)]
+    conn = robot.CncConnection(Device(), None)
+    def op(chunk):
+        conn.data_received(chunk)
+    def reset():
+        conn.rx_queue = asyncio.Queue()
+    return op, chunks, reset
+
+@benchmark
+def progress_process_line(args):
+    """ progress plugin tracking E and Z for one line """
+    state = gcodestate.ModalState()
+    lines = [l for l in workload('mixed', DATASET, args.seed) if not l.startswith(';')]
+    lines = [l.partition(';')[0].strip() for l in lines]
+    return state.process, lines
+
+@benchmark
+def classify(args):
+    """ classifying a received line, done once for every line """
+    firmware = flavour.get_firmware('marlin')
+    lines = responses(random.Random(args.seed))
+    return firmware.classify, lines
+
+def measure(loop, setup, args):
+    prepared = setup(args)
+    op, items = prepared[:2]
+    reset = prepared[2] if len(prepared) > 2 else None
+    is_async = asyncio.iscoroutinefunction(op)
+    async def run_async():
+        start = perf_counter()
+        for item in items:
+            await op(item)
+        return perf_counter() - start
+    def run_sync():
+        start = perf_counter()
+        for item in items:
+            op(item)
+        return perf_counter() - start
+    best = None
+    for i in range(args.repeat + 1): ## first one warms up
+        if reset: reset()
+        gc.collect()
+        gc.disable()
+        try:
+            elapsed = loop.run_until_complete(run_async()) if is_async else run_sync()
+        finally:
+            gc.enable()
+        ## let tasks created by the benchmark finish outside the timing
+        loop.run_until_complete(asyncio.sleep(0))
+        if i and (best is None or elapsed < best):
+            best = elapsed
+    return best / len(items) * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of cncd hot paths")
+    parser.add_argument("names", nargs='*', help="benchmarks to run, default all")
+    parser.add_argument("-r", "--repeat", type=int, default=7)
+    parser.add_argument("--subscribers", type=int, default=10,
+        help="clients subscribed for the trace benchmarks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results saved earlier")
+    parser.add_argument("--threshold", type=float, default=1.5,
+        help="fail when slower than this times the baseline")
+    parser.add_argument("-l", "--list", action="store_true")
+    args = parser.parse_args()
+    if args.list:
+        for name, func in BENCHMARKS.items():
+            print("{:<24} {}".format(name, func.__doc__.strip()))
+        return 0
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmark(s): {}".format(', '.join(sorted(unknown))))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fd:
+            baseline = json.load(fd)['ns_per_op']
+
+    ## the benchmarks log nothing worth seeing
+    log.getLogger().setLevel(log.CRITICAL)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = {}
+    failed = []
+    print("{:<24} {:>10} {:>10} {:>7}".format("benchmark", "ns/op", "baseline", "ratio"))
+    for name in args.names or BENCHMARKS:
+        ns = results[name] = round(measure(loop, BENCHMARKS[name], args), 1)
+        base = baseline.get(name)
+        ratio = ns / base if base else None
+        flag = ""
+        if ratio and ratio > args.threshold:
+            failed.append(name)
+            flag = " REGRESSION"
+        print("{:<24} {:>10.0f} {:>10} {:>7}{}".format(name, ns,
+            "{:.0f}".format(base) if base else "-",
+            "{:.2f}".format(ratio) if ratio else "-", flag))
+    if args.save:
+        with open(args.save, 'w') as fd:
+            json.dump({'ns_per_op': results, 'parameters': {'repeat': args.repeat,
+                'subscribers': args.subscribers, 'seed': args.seed, 'dataset': DATASET}},
+                fd, indent=2)
+            fd.write('\n')
+    if failed:
+        print("Slower than {}x baseline: {}".format(args.threshold, ', '.join(failed)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+## End to end throughput of cncd. Starts the daemon with a number of
+## simulated devices (see simulator.py), streams a synthetic job to each of
+## them while clients subscribe to every device through frontends/libcnc.
+## Reports lines/s and ack round trip times per device, command round trip
+## times as an upper bound of the event loop lag, and CPU time and RSS of the
+## daemon. Results are written as JSON so runs can be compared.
+##
+## cncd refuses to run as root, when benchmarking as root pass --user.
+## Usage: bench/throughput.py --devices 4 --clients 2 --workload mixed -o run.json
+
+import os, sys, asyncio, json, math, random, shutil, subprocess, tempfile, time
+import argparse
+from functools import partial
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, os.path.join(ROOT, 'frontends'))
+from libcnc.cnc import CncProtocol, Controller
+
+WORKLOADS = ('segments', 'arcs', 'mixed')
+## seconds between polls of the daemon
+POLL = .1
+
+CONFIG = """[general]
+unix_socket = {dir}/cncd.sock
+log_level = warning
+plugin_path = {root}/plugins
+plugins_enabled = {plugins}
+cnc_devices = {devices}
+cache_dir = {dir}/cache
+"""
+DEVICE = """
+[{handle}]
+name = {handle}
+port = dummy://{dialect}:{baud}
+library = {dir}
+firmware = {dialect}
+sim_speedup = {speedup}
+"""
+
+def workload(kind, lines, seed=0):
+    """ Synthetic job of about lines lines of G-code. Returns the lines.
+        segments: short straight extrusions as sliced curves are,
+        arcs: G2/G3 moves, mixed: layers with travel, segments, arcs, fan
+        changes and comments. """
+    rnd = random.Random(seed)
+    out = ['G21', 'G90', 'M82', 'G92 E0', 'G1 Z0.2 F600']
+    x, y, z, e = 100., 100., .2, 0.
+    while len(out) < lines:
+        if kind == 'mixed' and rnd.random() < .002:
+            z += .2
+            out.append(';LAYER_CHANGE')
+            out.append('G1 Z{:.2f} F600'.format(z))
+            out.append('M106 S{}'.format(rnd.randrange(256)))
+        if kind == 'arcs' or (kind == 'mixed' and rnd.random() < .2):
+            i, j = rnd.uniform(-5, 5), rnd.uniform(-5, 5)
+            e += .05
+            out.append('G{} X{:.3f} Y{:.3f} I{:.3f} J{:.3f} E{:.5f} F1800'.format(
+                rnd.choice((2, 3)), x, y, i, j, e))
+            continue
+        if kind == 'mixed' and rnd.random() < .05:
+            x, y = rnd.uniform(10, 190), rnd.uniform(10, 190)
+            out.append('G0 X{:.3f} Y{:.3f} F9000 ; travel'.format(x, y))
+            continue
+        angle = rnd.uniform(0, 2 * math.pi)
+        length = rnd.uniform(.1, 1.)
+        x = min(max(x + length * math.cos(angle), 0), 200)
+        y = min(max(y + length * math.sin(angle), 0), 200)
+        e += length * .033
+        out.append('G1 X{:.3f} Y{:.3f} E{:.5f} F1800'.format(x, y, e))
+    return out
+
+def percentiles(values):
+    if not values: return {}
+    values = sorted(values)
+    pick = lambda p: round(values[min(len(values) - 1, int(len(values) * p / 100))], 3)
+    return {'p50': pick(50), 'p95': pick(95), 'p99': pick(99), 'max': round(values[-1], 3)}
+
+def proc_stats(pid):
+    """ CPU seconds and RSS in KiB of a process, Linux only """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as fd:
+            fields = fd.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        with open('/proc/{}/status'.format(pid)) as fd:
+            rss = next(int(l.split()[1]) for l in fd if l.startswith('VmRSS:'))
+        return cpu, rss
+    except (OSError, StopIteration):
+        return None, None
+
+class Client(CncProtocol):
+    """ libcnc protocol that does not stop the loop when the daemon goes """
+    def connection_lost(self, exc):
+        self.closed = True
+
+async def open_client(loop, path):
+    transport, protocol = await loop.create_unix_connection(Client, path)
+    return Controller(protocol, None)
+
+def request(controller, cmd):
+    """ Send cmd, resolves to the list of decoded responses """
+    future = asyncio.get_event_loop().create_future()
+    msgs = []
+    def cb(msg):
+        msgs.append(msg)
+    def done(lines):
+        controller.cb(cb, lines)
+        if not future.done(): future.set_result(msgs)
+    controller.protocol.send_message(cmd, done)
+    return future
+
+async def wait_for_socket(path, proc, timeout):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if proc.poll() is not None:
+            raise RuntimeError("cncd exited with {}".format(proc.returncode))
+        if time.time() > deadline:
+            raise RuntimeError("cncd did not open {}".format(path))
+        await asyncio.sleep(POLL)
+
+async def measure(args, workdir, handles, proc):
+    loop = asyncio.get_event_loop()
+    sock = os.path.join(workdir, 'cncd.sock')
+    await wait_for_socket(sock, proc, args.timeout)
+    control = await open_client(loop, sock)
+    ## a separate client for the lag probe so it never queues behind polls
+    probe = await open_client(loop, sock)
+
+    received = [0] * args.clients
+    for n in range(args.clients):
+        client = await open_client(loop, sock)
+        def count(n, msg):
+            received[n] += 1
+        for handle in handles:
+            client.subscribe(partial(count, n), handle)
+
+    for handle in handles:
+        await request(control, 'connect {}'.format(handle))
+    cpu_start, _ = proc_stats(proc.pid)
+    start = time.time()
+    for handle in handles:
+        await request(control, 'start {} {}/{}.gcode'.format(handle, workdir, handle))
+
+    lags = []
+    async def probe_lag():
+        while True:
+            t = time.perf_counter()
+            await request(probe, 'hello')
+            lags.append((time.perf_counter() - t) * 1000)
+            await asyncio.sleep(POLL)
+    prober = asyncio.ensure_future(probe_lag())
+
+    ## A device is done when the whole job is read, nothing is in flight
+    ## and no lines were written since the previous poll.
+    results = {}
+    written = {}
+    max_rss = 0
+    while len(results) < len(handles):
+        await asyncio.sleep(POLL)
+        _, rss = proc_stats(proc.pid)
+        max_rss = max(max_rss, rss or 0)
+        if time.time() - start > args.timeout:
+            break
+        for handle in handles:
+            if handle in results: continue
+            data = (await request(control, 'data {}'.format(handle)))[0][handle]
+            report = (await request(control, 'metrics {}'.format(handle)))[0][handle]
+            done = (data.get('idle') and data.get('progress') == data.get('filesize')
+                and not report['inflight'] and written.get(handle) == report['lines'])
+            written[handle] = report['lines']
+            if done:
+                report['seconds'] = round(time.time() - start - POLL, 3)
+                results[handle] = report
+    elapsed = time.time() - start
+    cpu_end, rss = proc_stats(proc.pid)
+    prober.cancel()
+
+    devices = {}
+    for handle in handles:
+        report = results.get(handle)
+        if not report:
+            devices[handle] = {'finished': False}
+            continue
+        devices[handle] = {
+            'finished':         True,
+            'lines':            report['lines'],
+            'seconds':          report['seconds'],
+            'lines_per_s':      round(report['lines'] / report['seconds'], 1),
+            'ack_rtt_ms_p50':   report['ack_rtt_ms_p50'],
+            'ack_rtt_ms_p95':   report['ack_rtt_ms_p95'],
+            'ack_rtt_ms_p99':   report['ack_rtt_ms_p99'],
+            'ack_rtt_ms':       report['ack_rtt_ms'],
+        }
+    finished = [d for d in devices.values() if d['finished']]
+    await request(control, 'shutdown')
+    return {
+        'devices':          devices,
+        'total_lines_per_s': round(sum(d['lines'] for d in finished) / elapsed, 1),
+        'seconds':          round(elapsed, 3),
+        'client_messages':  received,
+        'client_messages_per_s': round(sum(received) / elapsed, 1),
+        'loop_lag_ms':      percentiles(lags),
+        'cpu_seconds':      None if cpu_start is None else round(cpu_end - cpu_start, 2),
+        'cpu_percent':      None if cpu_start is None else round((cpu_end - cpu_start) / elapsed * 100, 1),
+        'rss_kb_max':       max(max_rss, rss or 0) or None,
+    }
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='cncd-bench-')
+    try:
+        handles = ['dev{}'.format(i) for i in range(args.devices)]
+        job = workload(args.workload, args.lines, args.seed)
+        expected = sum(1 for line in job if not line.startswith(';'))
+        cfg = CONFIG.format(dir=workdir, root=os.path.abspath(ROOT),
+            plugins=args.plugins, devices=','.join(handles))
+        for handle in handles:
+            cfg += DEVICE.format(handle=handle, dialect=args.dialect,
+                baud=args.baud, dir=workdir, speedup=args.speedup)
+            with open(os.path.join(workdir, handle + '.gcode'), 'w') as fd:
+                fd.write('\n'.join(job) + '\n')
+        with open(os.path.join(workdir, 'cncd.conf'), 'w') as fd:
+            fd.write(cfg)
+        if args.user:
+            shutil.chown(workdir, args.user)
+            for name in os.listdir(workdir):
+                shutil.chown(os.path.join(workdir, name), args.user)
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'cncd.py'),
+                '-c', os.path.join(workdir, 'cncd.conf'), '-L'],
+            cwd=ROOT, user=args.user, stdout=subprocess.DEVNULL,
+            stderr=None if args.verbose else subprocess.DEVNULL)
+        try:
+            result = asyncio.run(measure(args, workdir, handles, proc))
+            proc.wait(args.timeout)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+        result['parameters'] = {key: value for key, value in vars(args).items()
+            if key not in ('output', 'verbose', 'user')}
+        result['parameters']['job_lines'] = expected
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End to end throughput of cncd")
+    parser.add_argument("-d", "--devices", type=int, default=1)
+    parser.add_argument("-c", "--clients", type=int, default=1,
+        help="clients subscribed to every device")
+    parser.add_argument("-w", "--workload", choices=WORKLOADS, default='mixed')
+    parser.add_argument("-n", "--lines", type=int, default=20000,
+        help="lines of G-code per job")
+    parser.add_argument("--dialect", default='marlin')
+    parser.add_argument("--baud", type=int, default=115200,
+        help="0 for an infinitely fast link")
+    parser.add_argument("--speedup", type=float, default=1000,
+        help="how much faster than real time the machines move")
+    parser.add_argument("--plugins", default='progress, data, trace, temperature')
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--user", help="run cncd as this user")
+    parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show cncd output")
+    args = parser.parse_args()
+    if not os.geteuid() and not args.user:
+        parser.error("cncd refuses to run as root, pass --user")
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(text + '\n')
+    else:
+        print(text)
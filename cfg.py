@@ -12,6 +12,19 @@ DEFAULTS = {
         "plugins_enabled":  "",
         "cnc_devices":  "",
         "cameras":  "",
+        ## compiled jobs, size in MiB
+        "cache_dir":    "/var/cache/cncd",
+        "cache_size":   "1024",
+        ## per client connection write buffer. Above high water mark
+        ## writers are asked to back off until it drains below low water
+        ## mark. A client that lets it grow beyond max is disconnected.
+        "client_write_high":    "65536",
+        "client_write_low":     "16384",
+        "client_write_max":     "1048576",
+        ## keep the datastore in this file across restarts, empty for
+        ## none. Written every interval seconds.
+        "datastore_file":       "",
+        "datastore_interval":   "5",
     }
 }
 
@@ -8,10 +8,14 @@ import os, socket, traceback
 import handlers, robot, serial
 from pluginmanager import PluginManager
 from cfg import load_configuration
-from datastore import DataStore
+from datastore import DataStore, SNAPSHOT_INTERVAL
+from jobcache import JobCache
 
 CLEAN_EXIT = True
 
+## local context of a command, see command()
+Lctx = namedtuple("Lctx", "nonce writeln argv write_json drain write_encoded")
+
 class Handler:
     def __init__(self, name, cb):
         self.cb = cb
@@ -64,23 +68,35 @@ def command(line, gctx, cctx={'uid':0}, loopback=False):
     else:
         cb = handlers.last_resort
     ## we have a handler, construct a local context
-    def writeln(msg):
+    prefix = "{} ".format(nonce).encode()
+    def write_encoded(line):
+        """ line is bytes ending in a newline, e.g. a message encoded once
+            for many clients """
         if loopback: return
         ## This function might be called by a log handler.
         ## do not emit any log messages in this func!
-        line = str(msg) + '\n'
         transport = cctx['transport']
         if transport.is_closing():
             ## an exception here would cause a log message to be emitted!
             ## so don't attempt to write!
             return
-        transport.write("{} {}".format(nonce, line).encode())
+        if transport.get_write_buffer_size() > cctx['write_max']:
+            ## Client doesn't read. Drop it rather than buffer forever.
+            transport.abort()
+            return
+        transport.write(prefix + line)
+    def writeln(msg):
+        if loopback: return
+        write_encoded((str(msg) + '\n').encode())
     def write_json(msg):
         ## ONLY ENABLE THIS AS LAST RESORT. WILL CAUSE LOOPS! ##
         ##            log.debug(json.dumps(msg))              ##
         return writeln(json.dumps(msg))
-    Lctx = namedtuple("Lctx", "nonce writeln argv write_json")
-    lctx = Lctx(nonce, writeln, argv, write_json)
+    async def drain():
+        """ Wait until the client caught up, use between large writes """
+        if loopback: return
+        await cctx['writable'].wait()
+    lctx = Lctx(nonce, writeln, argv, write_json, drain, write_encoded)
     task = asyncio.ensure_future(cb(gctx, cctx, lctx))
     task.add_done_callback(functools.partial(done_cb, gctx, cctx, lctx))
     return True
@@ -93,13 +109,31 @@ class SocketHandler(asyncio.Protocol):
         log.debug("instantiating new connection")
         self.data = ""
     def connection_made(self, transport):
+        general = self.gctx['cfg']['general']
+        transport.set_write_buffer_limits(
+                high=general.getint('client_write_high'),
+                low=general.getint('client_write_low'))
         self.cctx['transport'] = transport
+        self.cctx['write_max'] = general.getint('client_write_max')
+        self.cctx['writable'] = asyncio.Event()
+        self.cctx['writable'].set()
+        ## called when the client goes away, e.g. to end subscriptions
+        self.cctx['on_close'] = []
         prop = ['peername','sockname'][transport.get_extra_info('socket').family == socket.AF_UNIX]
         src = transport.get_extra_info(prop)
         log.info('Connection from {}'.format(src))
         transport.write("## CNCD\n".encode())
     def connection_lost(self, ex):
         log.info('Closed connection')
+        ## release anyone waiting to write
+        self.cctx['writable'].set()
+        for callback in self.cctx['on_close']:
+            callback()
+    ## No logging in these two, they are called from within writeln()
+    def pause_writing(self):
+        self.cctx['writable'].clear()
+    def resume_writing(self):
+        self.cctx['writable'].set()
     def eof_received(self):
         log.debug("Received EOF")
         return False
@@ -182,6 +216,23 @@ if __name__ == '__main__':
         gctx['datastore'] = DataStore()
 
         general = cfg["general"]
+        ## restore before devices and plugins read or update it
+        if general.get('datastore_file'):
+            try:
+                interval = general.getfloat('datastore_interval')
+            except ValueError:
+                interval = 0
+            if not interval > 0:
+                log.error("datastore_interval must be a positive number of seconds, using {}".format(SNAPSHOT_INTERVAL))
+                interval = SNAPSHOT_INTERVAL
+            gctx['datastore'].load(general['datastore_file'])
+            gctx['datastore'].persist(general['datastore_file'], interval)
+        ## created once, compiled jobs outlive a reboot. A new cache_dir
+        ## needs a restart, the size is picked up right away.
+        cache_size = general.getint('cache_size') * 1024 * 1024
+        if 'jobcache' not in gctx:
+            gctx['jobcache'] = JobCache(loop, general['cache_dir'], cache_size)
+        gctx['jobcache'].max_size = cache_size
 
         load_devices_from_cfg(gctx)
         load_webcams_from_cfg(gctx)
@@ -221,6 +272,7 @@ if __name__ == '__main__':
                 server.close()
                 loop.run_until_complete(server.wait_closed())
         gctx['pluginmanager'].unload_plugins()
+        gctx['datastore'].close()
         if not gctx['reboot']: break
 
     pending = asyncio.Task.all_tasks()
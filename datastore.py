@@ -1,5 +1,9 @@
-from collections import defaultdict
+import logging as log
+import asyncio, json, os
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from time import time
 from pluginmanager import plugin_hook
 
 ## The datastore can be used by anyone, including plugins to store information.
@@ -8,19 +12,139 @@ from pluginmanager import plugin_hook
 ## convention: keys are either the handles of the cnc devices or 'general'.
 ## Other values are allowed such as plugin specific data
 
+## Every update gets the next sequence number. The last CHANGELOG_SIZE updates
+## are remembered so clients can catch up with what changed since a sequence
+## number they saw. Numbers start at the startup time in ms, so they keep
+## increasing when the daemon restarts.
+CHANGELOG_SIZE = 4096
+
+## Optionally the data is kept in a file so it survives a reboot or crash.
+## Updates only mark their key dirty, every SNAPSHOT_INTERVAL seconds the
+## dirty keys are encoded again and the file is replaced in a worker thread.
+SNAPSHOT_INTERVAL = 5
+
+def write_atomic(path, text):
+    """ Replace path by text, never leaving a partial file behind """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
 class DataStore:
     def __init__(self):
         self.data = defaultdict(partial(defaultdict, str))
+        self.seq = int(time() * 1000)
+        ## (seq, devicename, name) of the latest updates
+        self.changelog = deque(maxlen=CHANGELOG_SIZE)
+        ## (devicename, name) changed since the last snapshot, None when
+        ## not persisting
+        self.dirty = None
+        self.path = None
+        self.task = None
+
+    def set(self, devicename, name, value):
+        self.seq += 1
+        self.changelog.append((self.seq, devicename, name))
+        self.data[devicename][name] = value
+        if self.dirty is not None:
+            self.dirty.add((devicename, name))
 
     @plugin_hook
     async def update(self, devicename, name, value):
-        self.data[devicename][name] = value
+        self.set(devicename, name, value)
     def update_nocoro(self, devicename, name, value):
         """
             Same as above but need not be awaited, also can't be hooked.
             Useful for init code
         """
-        self.data[devicename][name] = value
+        self.set(devicename, name, value)
     def get(self, devicename, name):
         return self.data[devicename][name]
+    def changed_since(self, devicename, seq):
+        """
+            Names of the keys of devicename updated after seq. None when the
+            changelog doesn't go back that far or seq is not one of ours.
+        """
+        oldest = self.changelog[0][0] if self.changelog else self.seq + 1
+        if seq < oldest - 1 or seq > self.seq:
+            return None
+        names = set()
+        for s, dev, name in reversed(self.changelog):
+            if s <= seq: break
+            if dev == devicename:
+                names.add(name)
+        return names
+
+    def load(self, path):
+        """ Restore the data of a snapshot, call before anyone uses the
+            store. Values come back as plain JSON types. """
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.error("Could not load datastore from '{}': {}".format(path, e))
+            return
+        for devicename, values in snapshot.get('data', {}).items():
+            self.data[devicename].update(values)
+        ## keep numbering after what clients might have seen
+        self.seq = max(self.seq, snapshot.get('seq', 0))
+        log.info("Loaded datastore from '{}'".format(path))
+
+    def persist(self, path, interval=SNAPSHOT_INTERVAL):
+        """ Start writing snapshots to path """
+        self.path = path
+        ## devicename -> name -> encoded value
+        self.encoded = defaultdict(dict)
+        self.dirty = {(dev, name) for dev, values in self.data.items() for name in values}
+        ## one thread, so snapshots are written in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = asyncio.ensure_future(self.write_behind(interval))
+
+    def encode(self):
+        """ Snapshot as compact JSON, only dirty values are encoded again """
+        dirty, self.dirty = self.dirty, set()
+        for devicename, name in dirty:
+            try:
+                self.encoded[devicename][name] = json.dumps(
+                    self.data[devicename][name], separators=(',', ':'))
+            except (TypeError, ValueError):
+                log.debug("Not saving {} of {}, not serializable".format(name, devicename))
+                self.encoded[devicename].pop(name, None)
+        devices = []
+        for devicename, values in self.encoded.items():
+            items = ','.join('{}:{}'.format(json.dumps(name), value)
+                for name, value in values.items())
+            devices.append('{}:{{{}}}'.format(json.dumps(devicename), items))
+        return '{{"seq":{},"data":{{{}}}}}'.format(self.seq, ','.join(devices))
+
+    async def write_behind(self, interval):
+        loop = asyncio.get_event_loop()
+        failed = False
+        while True:
+            await asyncio.sleep(interval)
+            if not self.dirty and not failed: continue
+            text = self.encode()
+            try:
+                await loop.run_in_executor(self.executor, write_atomic, self.path, text)
+                failed = False
+            except OSError as e:
+                if not failed:
+                    log.error("Could not save datastore to '{}': {}".format(self.path, e))
+                failed = True
 
+    def close(self):
+        """ Stop the timer and write a last snapshot """
+        if not self.task: return
+        self.task.cancel()
+        self.task = None
+        text = self.encode()
+        try:
+            ## queued behind a write still in progress
+            self.executor.submit(write_atomic, self.path, text).result()
+        except OSError as e:
+            log.error("Could not save datastore to '{}': {}".format(self.path, e))
+        self.executor.shutdown()
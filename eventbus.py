@@ -0,0 +1,118 @@
+import logging as log
+import asyncio
+from collections import OrderedDict, deque
+from time import monotonic
+
+## Plugins that hook hot code, e.g. every line received from a device, can do
+## so through events instead of POSTHOOKS. The hooked function then only
+## drops the call in a bounded queue owned by the plugin and continues. Each
+## plugin has its own task working through its queue. A slow plugin falls
+## behind and loses events, it never holds up a device.
+
+## Policies for when a queue is full. 'drop' discards the oldest event,
+## 'drop_new' the event being published. 'coalesce' keeps at most one event
+## per callback and arguments minus the last one, a newer event replaces the
+## value of the older but keeps its place in line. For DataStore.update that
+## means one pending event per key.
+POLICIES = ('drop', 'drop_new', 'coalesce')
+QUEUE_SIZE = 256
+
+class EventQueue:
+    """ Events of a single plugin waiting to be delivered """
+    def __init__(self, plugin, on_crash, size=QUEUE_SIZE, policy='drop'):
+        if policy not in POLICIES:
+            log.warning("Event policy ({}) of plugin '{}' not known, using drop.".format(policy, plugin.NAME))
+            policy = 'drop'
+        self.plugin = plugin
+        self.on_crash = on_crash
+        self.size = size
+        self.policy = policy
+        self.coalesce = policy == 'coalesce'
+        ## (callback, args, kwargs, time published), keyed when coalescing
+        self.pending = OrderedDict() if self.coalesce else deque()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        ## set while dropping, so a plugin lagging behind is logged once
+        self.overflow = False
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.lag = 0.
+        self.max_lag = 0.
+
+    def publish(self, callback, args, kwargs):
+        """ Never blocks, never calls plugin code """
+        self.published += 1
+        pending = self.pending
+        if self.coalesce:
+            key = (callback, args[:-1])
+            entry = pending.get(key)
+            if entry:
+                pending[key] = (callback, args, kwargs, entry[3])
+                self.coalesced += 1
+                return
+        depth = len(pending)
+        if depth >= self.size:
+            self.dropped += 1
+            if not self.overflow:
+                self.overflow = True
+                log.warning("Plugin '{}' can't keep up, dropping events.".format(self.plugin.NAME))
+            if self.policy == 'drop_new':
+                return
+            self.pop()
+        else:
+            depth += 1
+            if depth > self.max_depth: self.max_depth = depth
+        event = (callback, args, kwargs, monotonic())
+        if self.coalesce:
+            pending[key] = event
+        else:
+            pending.append(event)
+        if depth == 1: ## consumer might be waiting
+            if not self.task:
+                self.task = asyncio.ensure_future(self.consume())
+            self.wakeup.set()
+
+    def pop(self):
+        if self.coalesce:
+            return self.pending.popitem(last=False)[1]
+        return self.pending.popleft()
+
+    async def consume(self):
+        while True:
+            if not self.pending:
+                self.overflow = False
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            callback, args, kwargs, t = self.pop()
+            self.lag = monotonic() - t
+            if self.lag > self.max_lag: self.max_lag = self.lag
+            try:
+                await callback(*args, **kwargs)
+            except Exception as e:
+                self.on_crash(self.plugin)
+                return
+            self.delivered += 1
+
+    def close(self):
+        self.pending.clear()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def report(self):
+        return {
+            'policy':       self.policy,
+            'size':         self.size,
+            'depth':        len(self.pending),
+            'max_depth':    self.max_depth,
+            'published':    self.published,
+            'delivered':    self.delivered,
+            'dropped':      self.dropped,
+            'coalesced':    self.coalesced,
+            'lag_ms':       round(self.lag * 1000, 1),
+            'max_lag_ms':   round(self.max_lag * 1000, 1),
+        }
@@ -1,21 +1,164 @@
 import logging as log
+import re
+from time import time
+import telemetry
 
-class GenericFirmware:
-    def __init__(self):
-        self.prompt             = ""
-        self.max_buffer_lenght  = 1
-        self.stop_gcodes        = ['M104 S0', 'M140 S0']
-        self.abort_gcodes       = ['M112']
+## Firmware dialects as tables. A dialect names the dialect it is based on
+## and overrides settings and response patterns of it. Adding a firmware is
+## adding a table.
+##
+## Response patterns are tried in order on the start of every received line
+## (after the prompt), the first one matching decides the kind of the line.
+## Named groups are the fields of the response, a line with the 'ok' field
+## acknowledges a command.
 
-    def is_ack(self, line):
-        return line.startswith('ok')
+DIALECTS = {
+    'generic': {
+        'settings': {
+            'prompt':               "",
+            'max_buffer_lenght':    1,
+            ## size of the serial receive buffer of the firmware in bytes,
+            ## used when streaming = chars
+            'rx_buffer_size':       128,
+            'streaming':            'lines',
+            'stop_gcodes':          ['M104 S0', 'M140 S0'],
+            'abort_gcodes':         ['M112'],
+            ## after sending this gcode the printer expects line N next
+            'line_number_gcode':    "M110 N{}",
+            ## asks the firmware for its capabilities, None if it can't
+            'capability_report':    'M115',
+        },
+        'responses': [
+            ('resend',      r"(?i:(?:Resend:|rs)\s*N?:?)\s*(?P<line>\d+)"),
+            ('busy',        r"(?:echo:)?busy:"),
+            ('temperature', r"\s*(?:(?P<ok>ok)\s+)?(?P<sensors>T\d*:-?\d.*)"),
+            ('position',    r"\s*X:(?P<X>-?[\d.]+) Y:(?P<Y>-?[\d.]+) Z:(?P<Z>-?[\d.]+)(?: E:(?P<E>-?[\d.]+))?"),
+            ('capability',  r"Cap:(?P<name>[^:\s]+):(?P<value>\S*)"),
+            ('firmware',    r"(?:(?P<ok>ok)\s+)?(?P<info>FIRMWARE_NAME:.*)"),
+            ('ok',          r"(?P<ok>ok)"),
+            ('error',       r"!!"),
+            ('echo',        r"echo:(?P<text>.*)"),
+        ],
+    },
+    'marlin': {
+        'base': 'generic',
+        'responses': [
+            ('error',       r"ERROR:"),
+        ],
+    },
+    ## ONLY TESTED CONNECTED TO TELNET FOR SERIAL SETTINGS MAY DIFFER
+    'smoothie': {
+        'base': 'generic',
+        'settings': {
+            'prompt':               "> ",
+            'max_buffer_lenght':    20,
+            'rx_buffer_size':       256,
+            'line_number_gcode':    "N{} M110",
+        },
+    },
+    'smoothie-laser': {
+        'base': 'smoothie',
+        'settings': {
+            'stop_gcodes':          ['T1', 'M104 S0', 'T0'],
+        },
+    },
+    'grbl': {
+        'base': 'generic',
+        'settings': {
+            'rx_buffer_size':       127,
+            'streaming':            'chars',
+            'stop_gcodes':          ['M5', 'M9'],
+            'abort_gcodes':         ['\x18'], ## soft reset
+            'capability_report':    None,
+        },
+        'responses': [
+            ('error',       r"error:(?P<code>\S*)"),
+            ('status',      r"<(?P<state>[^|,>]*)(?P<report>[^>]*)>"),
+            ## pushed by itself, not an answer to a line
+            ('alarm',       r"ALARM:(?P<code>\S*)"),
+        ],
+    },
+}
+
+## fields of some kinds are parsed further, see PARSERS
+INFO_PATTERN = re.compile(r"([A-Z][A-Z_-]*):(.*?),?(?= [A-Z][A-Z_-]*:|$)")
+
+class Response:
+    """ A received line, classified """
+    __slots__ = ('kind', 'line', 'fields', 'ack')
+    def __init__(self, kind, line, fields):
+        self.kind = kind
+        self.line = line
+        self.fields = fields
+        self.ack = fields.get('ok') is not None
+
+    def __repr__(self):
+        return "<Response {} {}>".format(self.kind, self.fields)
+
+## kinds of which every line is the same, their responses are reused
+SHARED_KINDS = ('ok', 'busy')
+SHARED_MAX = 64
+
+def resolve(name):
+    """ Settings and responses of a dialect with those of its bases """
+    table = DIALECTS[name]
+    if 'base' in table:
+        settings, responses = resolve(table['base'])
+    else:
+        settings, responses = {}, []
+    settings = dict(settings, **table.get('settings', {}))
+    overrides = dict(table.get('responses', []))
+    responses = [(kind, overrides.pop(kind, pattern)) for kind, pattern in responses]
+    responses += list(overrides.items())
+    return settings, responses
+
+class Firmware:
+    def __init__(self, name):
+        self.name = name
+        settings, responses = resolve(name)
+        for key, value in settings.items():
+            setattr(self, key, value)
+        self.compile(responses)
+        self.shared = {}
 
-    def is_error(self, line):
-        return line.startswith('!!')
+    def compile(self, responses):
+        """ Combine the response patterns in one regex. Every pattern is
+            wrapped in a group, the index of the group that closed last
+            tells which pattern matched. Its fields are renamed to plain
+            groups, their indices are remembered per kind. """
+        parts = []
+        self.kinds = {}
+        index = 1
+        for kind, pattern in responses:
+            names = sorted(re.compile(pattern).groupindex.items(), key=lambda i: i[1])
+            plain = re.sub(r"\(\?P<\w+>", "(", pattern)
+            self.kinds[index] = (kind, [(name, index + i) for name, i in names])
+            parts.append("({})".format(plain))
+            index += re.compile(plain).groups + 1
+        self.classifier = re.compile('|'.join(parts))
+
+    def classify(self, line):
+        """ Response for a line received from the firmware """
+        shared = self.shared.get(line)
+        if shared: return shared
+        text = line
+        if self.prompt and text.startswith(self.prompt):
+            text = text[len(self.prompt):]
+        m = self.classifier.match(text)
+        if not m:
+            return Response('other', text, {})
+        kind, groups = self.kinds[m.lastindex]
+        fields = {name: m.group(i) for name, i in groups}
+        if kind in PARSERS:
+            PARSERS[kind](fields)
+        response = Response(kind, text, fields)
+        if kind in SHARED_KINDS and len(self.shared) < SHARED_MAX:
+            self.shared[line] = response
+        return response
 
     def set_next_linenumber(self, n:int):
         """after sending this gcode the printer should expect line n"""
-        return "M110 N{}".format(n)
+        return self.line_number_gcode.format(n)
 
     def strip_prompt(self, line):
         if self.prompt and line.startswith(self.prompt):
@@ -23,48 +166,35 @@ class GenericFirmware:
         else:
             return line
 
-class MarlinFirmware(GenericFirmware):
-    def __init__(self):
-        super().__init__()
-        self.prompt = ""
-
-    def is_error(self, line):
-        return line.startswith('ERROR:')
+def parse_resend(fields):
+    fields['line'] = int(fields['line'])
 
-class SmoothieFirmware(GenericFirmware):
-    ## ONLY TESTED CONNECTED TO TELNET FOR SERIAL SETTINGS MAY DIFFER
-    def __init__(self):
-        super().__init__()
-        self.prompt = "> "
-        self.max_buffer_lenght = 20
+def parse_temperature(fields):
+    fields['sensors'] = telemetry.readings(fields['sensors'], time())
 
-    def set_next_linenumber(self, n:int):
-        return "N{} M110".format(n)
+def parse_position(fields):
+    for axis in 'XYZE':
+        if fields[axis] is not None:
+            fields[axis] = float(fields[axis])
 
-class SmoothieLaserFirmware(SmoothieFirmware):
-    ## ONLY TESTED CONNECTED TO TELNET FOR SERIAL SETTINGS MAY DIFFER
-    def __init__(self):
-        super().__init__()
-        self.prompt = "> "
-        self.max_buffer_lenght = 20
-        self.stop_gcodes        = ['T1', 'M104 S0', 'T0']
-        self.abort_gcodes       = ['M112']
+def parse_capability(fields):
+    value = fields['value']
+    if value.isdigit():
+        fields['value'] = int(value)
 
-    def set_next_linenumber(self, n:int):
-        return "N{} M110".format(n)
+def parse_firmware(fields):
+    fields['info'] = dict(INFO_PATTERN.findall(fields['info'].strip()))
 
+PARSERS = {
+    'resend':       parse_resend,
+    'temperature':  parse_temperature,
+    'position':     parse_position,
+    'capability':   parse_capability,
+    'firmware':     parse_firmware,
+}
 
 def get_firmware(name):
-    if name == "marlin":
-        FW = MarlinFirmware
-    elif name == "smoothie":
-        FW = SmoothieFirmware
-    elif name == "smoothie-laser":
-        FW = SmoothieLaserFirmware
-    elif name == "generic":
-        FW = GenericFirmware
-    else:
-        log.warning("Firmware dialect ({}) not known, defaulting to generic.")
-        FW = GenericFirmware
-    return FW()
-
+    if name not in DIALECTS:
+        log.warning("Firmware dialect ({}) not known, defaulting to generic.".format(name))
+        name = 'generic'
+    return Firmware(name)
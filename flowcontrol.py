@@ -0,0 +1,191 @@
+import logging as log
+import asyncio
+from collections import deque
+from functools import reduce
+from operator import xor
+
+## A window keeps track of the lines sent to the device but not yet
+## acknowledged. The sender acquires room in the window before writing a
+## line, the receiver releases the oldest line on every ack.
+
+class LineWindow:
+    """ Limits the number of lines in flight """
+    def __init__(self, size):
+        self.size = size
+        self.inflight = deque()
+        self.released = asyncio.Event()
+        ## set when the sender had to wait for room
+        self.blocked = False
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def fits(self, line):
+        return len(self.inflight) < self.size
+
+    async def acquire(self, line):
+        while not self.fits(line):
+            self.blocked = True
+            self.released.clear()
+            await self.released.wait()
+        self.inflight.append(line)
+
+    def release(self):
+        """ Called for every ack. Returns oldest line in flight or None """
+        if not self.inflight:
+            return None
+        self.released.set()
+        return self.inflight.popleft()
+
+    def cancel(self, line):
+        """ Undo the last acquire """
+        self.inflight.pop()
+
+    def flush(self):
+        self.inflight.clear()
+        self.released.set()
+
+class CharWindow(LineWindow):
+    """ Grbl style character counting. Limits the number of bytes in flight
+        to the size of the receive buffer of the firmware. A line that is
+        larger than the buffer is still allowed when nothing is in flight,
+        otherwise we would block forever. """
+    def __init__(self, size):
+        super().__init__(size)
+        self.used = 0
+
+    def fits(self, line):
+        return not self.inflight or self.used + len(line) + 1 <= self.size
+
+    async def acquire(self, line):
+        await super().acquire(line)
+        self.used += len(line) + 1
+
+    def release(self):
+        line = super().release()
+        if line is not None:
+            self.used -= len(line) + 1
+        return line
+
+    def cancel(self, line):
+        super().cancel(line)
+        self.used -= len(line) + 1
+
+    def flush(self):
+        super().flush()
+        self.used = 0
+
+## adaptive window tuning, see AdaptiveController
+SLOW_FACTOR = 2.0
+BASE_DECAY = 1.05
+
+class AdaptiveController:
+    """ Adapts the size of a LineWindow at runtime, starting from the
+        size of the firmware dialect. Once per window worth of acks the
+        average ack round trip time is compared to the lowest seen. When
+        acks are fast while the sender was held back by the window, it grows
+        by one line. When acks get slow it shrinks by one. Errors halve it,
+        busy responses shrink it by one. The lowest round trip time slowly
+        creeps up so the baseline follows a slower machine. """
+    def __init__(self, window, minimum, maximum):
+        self.window = window
+        self.minimum = minimum
+        self.maximum = maximum
+        self.base = None
+        self.rtt_sum = 0
+        self.count = 0
+        self.resize(window.size)
+
+    def acked(self, rtt):
+        if rtt is None: return
+        self.rtt_sum += rtt
+        self.count += 1
+        if self.count < self.window.size: return
+        avg = self.rtt_sum / self.count
+        self.rtt_sum = self.count = 0
+        if self.base is None:
+            self.base = avg
+        self.base = min(avg, self.base * BASE_DECAY)
+        if avg > self.base * SLOW_FACTOR:
+            self.resize(self.window.size - 1)
+        elif self.window.blocked:
+            self.resize(self.window.size + 1)
+        self.window.blocked = False
+
+    def error(self):
+        self.resize(self.window.size // 2)
+
+    def busy(self):
+        self.resize(self.window.size - 1)
+
+    def resize(self, size):
+        size = max(self.minimum, min(self.maximum, size))
+        if size > self.window.size:
+            self.window.released.set() ## sender might be waiting for room
+        self.window.size = size
+
+def checksum(line):
+    return reduce(xor, line.encode(), 0)
+
+class ResendBuffer:
+    """ Numbers and checksums outgoing lines and remembers the last few so
+        they can be replayed when the firmware asks for a resend. """
+    def __init__(self, size):
+        self.history = deque(maxlen=size)
+        self.replay = deque()
+        self.next_n = 0
+        self.last_request = None
+        self.duplicates = 0
+
+    def format(self, line):
+        """ Format line with the next line number, does not commit """
+        numbered = "N{} {}".format(self.next_n, line)
+        return "{}*{}".format(numbered, checksum(numbered))
+
+    def commit(self, out):
+        self.history.append((self.next_n, out))
+        self.next_n += 1
+
+    def request(self, n, inflight):
+        """ Firmware asks to resend starting at line n. Every other line
+            in flight at that moment will be rejected by the firmware as
+            well, each with a request for the same line. Those are ignored.
+            Returns False if line n is no longer available. """
+        if n == self.last_request and self.duplicates > 0:
+            self.duplicates -= 1
+            return True
+        lines = [out for i, out in self.history if i >= n]
+        if not lines or self.history[-len(lines)][0] != n:
+            return False
+        self.replay = deque(lines)
+        self.last_request = n
+        self.duplicates = inflight - 1
+        return True
+
+    def flush(self):
+        self.replay.clear()
+
+def get_window(dev_cfg, firmware):
+    """ Construct the window for a device, device configuration overrides
+        the firmware defaults """
+    streaming = dev_cfg.get('streaming', firmware.streaming)
+    if streaming == 'chars':
+        size = dev_cfg.getint('rx_buffer_size', fallback=firmware.rx_buffer_size)
+        return CharWindow(size)
+    if streaming != 'lines':
+        log.warning("Streaming mode ({}) not known, defaulting to lines.".format(streaming))
+    size = dev_cfg.getint('max_buffer_length', fallback=firmware.max_buffer_lenght)
+    return LineWindow(size)
+
+def get_controller(dev_cfg, window):
+    """ Adaptive window controller if configured, None otherwise """
+    if not dev_cfg.getboolean('adaptive', fallback=False):
+        return None
+    if isinstance(window, CharWindow):
+        log.warning("Adaptive window not supported with character counting.")
+        return None
+    minimum = dev_cfg.getint('window_min', fallback=1)
+    ## Ack latency doesn't show an overrun receive buffer, lines are simply
+    ## lost. Growing beyond what the firmware is known to take is opt-in.
+    maximum = dev_cfg.getint('window_max', fallback=window.size)
+    return AdaptiveController(window, minimum, maximum)
@@ -496,6 +496,21 @@ class DeviceWindow(Window):
                 ignore.append('current_e')
                 ignore.append('final_e')
 
+        def parse_temperature(status, container, ignore):
+            ## readings are [sensor, current, target, timestamp]
+            readings = status.get('temperature')
+            if not readings: return
+            temps = []
+            for sensor, current, target, timestamp in readings:
+                if target is None:
+                    temps.append("{} {:0.1f}".format(sensor, current))
+                else:
+                    temps.append("{} {:0.1f}/{:0.1f}".format(sensor, current, target))
+            attr = 'Flabel'
+            w = AttrMap(Text("Temperature: " + "  ".join(temps)), attr, attr)
+            container.contents.append((w, container.options('pack')))
+            ignore.append('temperature')
+
         def parse_status(status, container, ignore):
             stat_cols = Columns([], 0)
             w = make_w(stat_cols, 'connected', 'connected', 'disconnected')
@@ -515,13 +530,14 @@ class DeviceWindow(Window):
                 attr = 'Flabel'
             w = AttrMap(Text(label), attr, attr)
             container.contents.append((w, container.options('pack')))
-        ignore = ['last_temp_request', 'temperature_obj']
+        ignore = []
         # We really got to properly parse this to some struct first
         container.contents.clear()
         ## progress
         parse_status(self.status, container, ignore)
         parse_progress(self.status, container, ignore)
         parse_time(self.status, container, ignore)
+        parse_temperature(self.status, container, ignore)
 
         for key, value in sorted(self.status.items()):
             if key in ignore: continue
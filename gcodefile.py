@@ -0,0 +1,145 @@
+import logging as log
+import asyncio
+import os, struct
+import gzip, lzma, bz2
+from concurrent.futures import ThreadPoolExecutor
+
+## Reading G-code from disk happens in large chunks on a worker thread. The
+## event loop only ever sees complete, already decoded lines. This way a slow
+## SD card stalls only the job being read, not every serial port and client
+## socket serviced by the same loop.
+
+CHUNK_SIZE = 1<<16
+
+## Compressed jobs are decompressed incrementally while reading, they are
+## never held in memory as a whole.
+COMPRESSED = {'.gz': gzip.open, '.xz': lzma.open, '.bz2': bz2.open}
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1].lower() in COMPRESSED
+
+def open_source(filename):
+    """ Open a G-code file for binary reading, decompress if needed """
+    opener = COMPRESSED.get(os.path.splitext(filename)[1].lower(), open)
+    return opener(filename, 'rb')
+
+def gzip_size(filename):
+    """ Blocking. Uncompressed size from the gzip trailer, only correct
+        modulo 4 GiB and for single member files. """
+    with open(filename, 'rb') as fd:
+        fd.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', fd.read(4))[0]
+
+def strip_comments(line):
+    """ Takes a raw line as bytes, returns the G-code without comments
+        and surrounding whitespace """
+    idx = line.find(b';')
+    if idx >= 0:
+        line = line[:idx]
+    return line.strip()
+
+def raw_lines(fd, chunk_size=CHUNK_SIZE, limit=None):
+    """ Blocking generator, yields lists of raw lines including their line
+        ending. Only the last line of a file might lack one. Stops after
+        limit bytes when given. """
+    remainder = b''
+    while True:
+        if limit is not None:
+            chunk_size = min(chunk_size, limit)
+            limit -= chunk_size
+        data = fd.read(chunk_size) if chunk_size else b''
+        if not data:
+            if remainder:
+                yield [remainder]
+            return
+        lines = (remainder + data).split(b'\n')
+        remainder = lines.pop()
+        if lines:
+            yield [line + b'\n' for line in lines]
+
+class GcodeReader:
+    """ Asynchronous iterator over a compiled job (see jobcache). Each
+        iteration yields a batch of lines as str. While the caller works
+        through a batch the next chunk is read ahead in the executor, thus at
+        most two chunks are held in memory at any time. Reads run on a
+        thread of the reader's own, one at a time. """
+
+    def __init__(self, filename, loop, offset=0, chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.loop = loop
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.fd = None
+        self.chunks = None
+        self.pending = None
+        self.executor = None
+
+    def run(self, func):
+        return asyncio.wrap_future(self.executor.submit(func), loop=self.loop)
+
+    def _open(self):
+        fd = open(self.filename, 'rb')
+        fd.seek(self.offset)
+        return fd
+
+    async def __aenter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        opening = self.executor.submit(self._open)
+        try:
+            self.fd = await asyncio.wrap_future(opening, loop=self.loop)
+        except BaseException:
+            ## __aexit__ won't run. A cancelled open might still succeed.
+            opening.add_done_callback(self._discard)
+            self.executor.shutdown(wait=False)
+            raise
+        self.chunks = raw_lines(self.fd, self.chunk_size)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        pending, self.pending = self.pending, None
+        if pending:
+            ## a cancelled read still runs, don't complain about its result
+            pending.add_done_callback(self._retrieve)
+        if self.fd:
+            ## Never close the file under the feet of the worker thread. The
+            ## wrapper of a read is done as soon as it is cancelled, the read
+            ## itself is not. Closing on the same thread waits for it.
+            self.executor.submit(self.fd.close)
+            self.fd = None
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def _discard(future):
+        if not future.cancelled() and not future.exception():
+            future.result().close()
+
+    @staticmethod
+    def _retrieve(future):
+        if not future.cancelled():
+            future.exception()
+
+    def _read_chunk(self):
+        """ Runs in executor, must not touch the event loop """
+        lines = next(self.chunks, None)
+        if not lines: return []
+        data = b''.join(lines).decode()
+        if data.endswith('\n'):
+            data = data[:-1]
+        return data.split('\n')
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.pending:
+            self.pending = self.run(self._read_chunk)
+        batch = await self.pending
+        if not batch:
+            self.pending = None
+            raise StopAsyncIteration
+        ## read ahead while the caller is busy with this batch
+        self.pending = self.run(self._read_chunk)
+        return batch
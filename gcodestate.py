@@ -0,0 +1,143 @@
+import re
+
+## Tracks the modal state of a machine while G-code is fed through it. Used to
+## continue a job halfway: the skipped part of the job is scanned once and the
+## resulting state is established on the machine before streaming the rest.
+## The progress plugin follows a running job with it as well, so the resumed
+## machine and the reported position agree.
+
+WORD = re.compile(r"([A-Z])\s*(-?\d*\.?\d+)")
+
+def fmt(value):
+    return "{:.5f}".format(value).rstrip('0').rstrip('.')
+
+def words(args):
+    ## WORD only matches valid numbers
+    return {letter: float(value) for letter, value in WORD.findall(args.upper())}
+
+class ModalState:
+    def __init__(self):
+        self.absolute = True
+        self.absolute_e = True
+        self.metric = True
+        self.position = {'X':0., 'Y':0., 'Z':0., 'E':0.}
+        ## sum of all offsets applied by G92 per axis. Position plus offset
+        ## is the position as if G92 was never used, for E the total
+        ## filament extruded. G92 itself moves nothing.
+        self.offsets = {'X':0., 'Y':0., 'Z':0., 'E':0.}
+        self.feedrate = None
+        self.hotend = {}
+        self.bed = None
+        self.fan = None
+        self.tool = None
+
+    @property
+    def extruded(self):
+        return self.position['E'] + self.offsets['E']
+
+    @property
+    def height(self):
+        return self.position['Z'] + self.offsets['Z']
+
+    def process(self, line):
+        cmd, _, args = line.partition(' ')
+        cmd = cmd.upper()
+        handler = ModalState.DISPATCH.get(cmd)
+        if handler:
+            handler(self, args)
+        elif cmd[:1] == 'T' and cmd[1:].isdigit():
+            self.tool = int(cmd[1:])
+
+    def move(self, args):
+        ## done for nearly every line of a job, keep it lean
+        position = self.position
+        for letter, value in WORD.findall(args.upper()):
+            if letter in position:
+                if self.absolute_e if letter == 'E' else self.absolute:
+                    position[letter] = float(value)
+                else:
+                    position[letter] += float(value)
+            elif letter == 'F':
+                self.feedrate = float(value)
+
+    def set_position(self, args):
+        d = words(args)
+        for axis in 'XYZE':
+            if axis in d:
+                self.offsets[axis] += self.position[axis] - d[axis]
+                self.position[axis] = d[axis]
+
+    def set_absolute(self, args):
+        self.absolute = self.absolute_e = True
+
+    def set_relative(self, args):
+        self.absolute = self.absolute_e = False
+
+    def set_absolute_e(self, args):
+        self.absolute_e = True
+
+    def set_relative_e(self, args):
+        self.absolute_e = False
+
+    def set_inch(self, args):
+        self.metric = False
+
+    def set_metric(self, args):
+        self.metric = True
+
+    def set_hotend(self, args):
+        d = words(args)
+        target = d.get('S', d.get('R'))
+        if target is None: return
+        tool = int(d.get('T', self.tool or 0))
+        self.hotend[tool] = target
+
+    def set_bed(self, args):
+        d = words(args)
+        target = d.get('S', d.get('R'))
+        if target is not None:
+            self.bed = target
+
+    def fan_on(self, args):
+        self.fan = words(args).get('S', 255.)
+
+    def fan_off(self, args):
+        self.fan = 0.
+
+    DISPATCH = {
+        'G0': move, 'G1': move, 'G2': move, 'G3': move,
+        'G00': move, 'G01': move, 'G02': move, 'G03': move,
+        'G20': set_inch, 'G21': set_metric,
+        'G90': set_absolute, 'G91': set_relative, 'G92': set_position,
+        'M82': set_absolute_e, 'M83': set_relative_e,
+        'M104': set_hotend, 'M109': set_hotend,
+        'M140': set_bed, 'M190': set_bed,
+        'M106': fan_on, 'M107': fan_off,
+    }
+
+    def preamble(self):
+        """ G-code to bring a machine in this state. Heats up first and
+            waits for it, the position is left alone. The operator is
+            responsible for homing and clearing the part. """
+        lines = ['G21' if self.metric else 'G20']
+        if self.bed is not None:
+            lines.append('M140 S{}'.format(fmt(self.bed)))
+        for tool, target in sorted(self.hotend.items()):
+            lines.append('M104 T{} S{}'.format(tool, fmt(target)))
+        if self.bed:
+            lines.append('M190 S{}'.format(fmt(self.bed)))
+        for tool, target in sorted(self.hotend.items()):
+            if target:
+                lines.append('M109 T{} S{}'.format(tool, fmt(target)))
+        if self.tool is not None:
+            lines.append('T{}'.format(self.tool))
+        if self.fan:
+            lines.append('M106 S{}'.format(fmt(self.fan)))
+        elif self.fan is not None:
+            lines.append('M107')
+        lines.append('G90' if self.absolute else 'G91')
+        lines.append('M82' if self.absolute_e else 'M83')
+        lines.append('G92 E{}'.format(fmt(self.position['E'])))
+        if self.feedrate:
+            lines.append('G1 F{}'.format(fmt(self.feedrate)))
+        return lines
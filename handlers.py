@@ -75,7 +75,10 @@ async def stat(gctx, cctx, lctx, dev):
     if libpath.endswith('/'):
         libpath = libpath[:-1]
     files = await lsdir(libpath)
-    msg = {'files':files}
+    ## compressed jobs are reported with their uncompressed size
+    sizes = await gctx['loop'].run_in_executor(None, gctx['jobcache'].sizes, files)
+    msg = {'files':files, 'sizes':sizes}
+    await lctx.drain()
     lctx.write_json(msg)
 
 async def hello(gctx, cctx, lctx):
@@ -145,9 +148,27 @@ async def disconnect(gctx, cctx, lctx, dev):
 @nargs(3)
 @parse_device
 async def start(gctx, cctx, lctx, dev):
-    """start executing gcode"""
+    """start executing gcode. 'start DEVICE FILE [--from-line N | --from-layer L]'
+    N is a line number of FILE as shown by editors, counted from 1. When
+    that line holds no G-code the job continues at the next one that does.
+    Layers are counted from 0."""
     filename = lctx.argv[2]
-    if not await dev.start(filename):
+    options = lctx.argv[3:]
+    line, layer = 0, None
+    if options:
+        if len(options) != 2 or options[0] not in ('--from-line', '--from-layer'):
+            return "Expected --from-line N or --from-layer L"
+        try:
+            value = int(options[1])
+        except ValueError:
+            return "Line or layer must be a number"
+        if value < 0:
+            return "Line or layer must not be negative"
+        if options[0] == '--from-line':
+            line = value
+        else:
+            layer = value
+    if not await dev.start(filename, line, layer):
         return "Start failed"
 
 @nargs(2)
@@ -178,6 +199,19 @@ async def resume(gctx, cctx, lctx, dev):
     if not await dev.resume():
         return "resume failed"
 
+@nargs(2)
+@parse_device
+async def metrics(gctx, cctx, lctx, dev):
+    """streaming statistics: ack round trip times, rates, queue depths and
+    scheduled status queries"""
+    report = dev.metrics.report()
+    report['queries'] = dev.queries.report()
+    lctx.write_json({dev.handle: report})
+
+async def events(gctx, cctx, lctx):
+    """event queue statistics per plugin: depth, drops and lag"""
+    lctx.write_json(gctx['pluginmanager'].event_stats())
+
 async def quit(gctx, cctx, lctx):
     """Disconnect this client."""
     log.debug("Closing my side of pipe")
@@ -230,4 +264,4 @@ async def loglevel(gctx, cctx, lctx):
 
 handlers = [connect, disconnect, quit, shutdown, reboot, help, 
     devlist, camlist, loglevel, stat, hello,
-    start, stop, abort, pause, resume, dumpconfig, dumpgctx, dumpcctx, dumplctx]
+    start, stop, abort, pause, resume, metrics, events, dumpconfig, dumpgctx, dumpcctx, dumplctx]
@@ -0,0 +1,323 @@
+import logging as log
+import asyncio
+import os, hashlib, struct, tempfile
+from array import array
+from bisect import bisect_right
+import gcodefile, gcodestate
+
+## Every job is compiled once in to a compact form: comments stripped and
+## empty lines dropped, one line of G-code per '\n'. Next to it an index is
+## stored with the byte offset of every INDEX_STRIDE-th line, both in the
+## compiled and in the source file, its line number in the source file and
+## the first line of every layer.
+## Entries are keyed on path, mtime and size of the source so an edited file
+## is compiled again.
+##
+##   <key>.gcode    compiled G-code
+##   <key>.idx      HEADER, offsets, source_offsets, source_lines, layers
+
+INDEX_STRIDE = 256
+MAGIC = b'CNCJ'
+VERSION = 3
+## magic, version, stride, line count, compiled size, source size, layers
+HEADER = struct.Struct('<4sHIQQQQ')
+LAYER_MARKERS = (b';LAYER:', b';LAYER_CHANGE')
+
+class LayerFinder:
+    """ Finds the first line of every layer. Slicer comments are
+        preferred. Without those a layer starts at the last Z move before
+        a printing move (X or Y with E), provided it is above the previous
+        layer. This ignores Z hops. Works on compiled bytes, cheap enough to
+        run for every line while compiling. """
+    def __init__(self):
+        self.marked = array('Q')
+        self.moved = array('Q')
+        self.absolute = True
+        self.z = 0.
+        self.layer_z = None
+        self.candidate = None
+
+    def comment(self, raw, n):
+        if raw.lstrip().startswith(LAYER_MARKERS):
+            self.marked.append(n)
+
+    def line(self, line, n):
+        if line.startswith(b'G9'):
+            if line.startswith(b'G90'): self.absolute = True
+            elif line.startswith(b'G91'): self.absolute = False
+            return
+        if not line.startswith((b'G0 ', b'G1 ')): return
+        idx = line.find(b'Z')
+        if idx >= 0:
+            z = gcodestate.WORD.match(line[idx:].decode())
+            if z:
+                z = float(z.group(2))
+                self.z = z if self.absolute else self.z + z
+                self.candidate = n
+        if self.candidate is None or b'E' not in line: return
+        if b'X' not in line and b'Y' not in line: return
+        if self.layer_z is None or self.z > self.layer_z:
+            self.moved.append(self.candidate)
+            self.layer_z = self.z
+        self.candidate = None
+
+    def layers(self):
+        return self.marked or self.moved
+
+class Job:
+    """ A compiled job in the cache """
+    def __init__(self, path, lines, size, source_size, offsets, source_offsets,
+            source_lines, layers, stride=INDEX_STRIDE):
+        self.path = path
+        self.lines = lines
+        self.size = size
+        self.source_size = source_size
+        self.offsets = offsets
+        self.source_offsets = source_offsets
+        ## counted from 0
+        self.source_lines = source_lines
+        self.layers = layers
+        self.stride = stride
+
+    def dump(self, fd):
+        fd.write(HEADER.pack(MAGIC, VERSION, self.stride, self.lines,
+            self.size, self.source_size, len(self.layers)))
+        self.offsets.tofile(fd)
+        self.source_offsets.tofile(fd)
+        self.source_lines.tofile(fd)
+        self.layers.tofile(fd)
+
+    def layer_line(self, layer):
+        """ First line of layer, raises ValueError if there is no such layer """
+        if not 0 <= layer < len(self.layers):
+            raise ValueError("Layer {} out of range, job has {} layers".format(layer, len(self.layers)))
+        return self.layers[layer]
+
+    def source_line(self, source, line):
+        """ Blocking. The compiled line of source line line (counted from
+            1, as editors do) or the first one after it when line holds no
+            G-code. At most stride compiled lines of source are read. """
+        block = bisect_right(self.source_lines, line - 1) - 1
+        if block < 0: return 0
+        compiled, n = block * self.stride, self.source_lines[block]
+        with gcodefile.open_source(source) as fd:
+            fd.seek(self.source_offsets[block])
+            for raw in fd:
+                if gcodefile.strip_comments(raw):
+                    if n >= line - 1:
+                        return compiled
+                    compiled += 1
+                n += 1
+        raise ValueError("Line {} out of range, no G-code after line {}".format(line, n))
+
+    def seek(self, line):
+        """ Blocking. Byte offset of line in the compiled file. At most
+            stride lines are read, the rest comes from the index. """
+        if not 0 <= line < self.lines:
+            raise ValueError("Line {} out of range, job has {} lines".format(line, self.lines))
+        block = line // self.stride
+        offset = self.offsets[block]
+        with open(self.path, 'rb') as fd:
+            fd.seek(offset)
+            for _ in range(line - block * self.stride):
+                offset += len(fd.readline())
+        return offset
+
+    def scan(self, line):
+        """ Blocking. Returns offset of line and the modal state of the
+            machine right before it. """
+        offset = self.seek(line)
+        state = gcodestate.ModalState()
+        with open(self.path, 'rb') as fd:
+            for chunk in gcodefile.raw_lines(fd, limit=offset):
+                for raw in b''.join(chunk).decode().split('\n'):
+                    state.process(raw)
+        return offset, state
+
+    @classmethod
+    def load(cls, path, fd):
+        """ Returns None if the index is not usable """
+        header = fd.read(HEADER.size)
+        if len(header) != HEADER.size: return None
+        magic, version, stride, lines, size, source_size, nlayers = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION: return None
+        count = (lines + stride - 1) // stride
+        offsets, source_offsets = array('Q'), array('Q')
+        source_lines, layers = array('Q'), array('Q')
+        try:
+            offsets.fromfile(fd, count)
+            source_offsets.fromfile(fd, count)
+            source_lines.fromfile(fd, count)
+            layers.fromfile(fd, nlayers)
+        except EOFError:
+            return None
+        return cls(path, lines, size, source_size, offsets, source_offsets,
+                source_lines, layers, stride)
+
+def compile_job(source, path):
+    """ Blocking, strip source in to path. Returns Job """
+    offsets, source_offsets, source_lines = array('Q'), array('Q'), array('Q')
+    finder = LayerFinder()
+    lines = size = source_size = source_line = 0
+    with gcodefile.open_source(source) as src, open(path, 'wb') as dst:
+        for chunk in gcodefile.raw_lines(src):
+            out = []
+            for raw in chunk:
+                line = gcodefile.strip_comments(raw)
+                if line:
+                    if not lines % INDEX_STRIDE:
+                        offsets.append(size)
+                        source_offsets.append(source_size)
+                        source_lines.append(source_line)
+                    finder.line(line, lines)
+                    out.append(line)
+                    size += len(line) + 1
+                    lines += 1
+                elif raw.find(b';') >= 0:
+                    finder.comment(raw, lines)
+                source_size += len(raw)
+                source_line += 1
+            if out:
+                out.append(b'')
+                dst.write(b'\n'.join(out))
+    return Job(path, lines, size, source_size, offsets, source_offsets,
+            source_lines, finder.layers())
+
+def user_cache_dir():
+    """ Fallback when the configured directory is not writable,
+        $XDG_CACHE_HOME/cncd or ~/.cache/cncd """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'cncd')
+
+class JobCache:
+    """ Directory of compiled jobs, evicts least recently used entries when
+        larger than max_size bytes """
+    def __init__(self, loop, directory, max_size):
+        self.loop = loop
+        self.max_size = max_size
+        self.compiling = {}
+        self.directory = None
+        for candidate in (directory, user_cache_dir()):
+            try:
+                os.makedirs(candidate, exist_ok=True)
+                if not os.access(candidate, os.W_OK):
+                    raise PermissionError(candidate)
+            except OSError as e:
+                log.error("Job cache not writable ({})".format(e))
+                continue
+            self.directory = candidate
+            break
+        else:
+            ## last resort, compiled again after a restart
+            self.directory = tempfile.mkdtemp(prefix='cncd-cache-')
+        if self.directory != directory:
+            log.error("Job cache in {} instead of {}".format(self.directory, directory))
+
+    def key(self, filename, st):
+        ident = "{}\0{}\0{}".format(os.path.realpath(filename), st.st_mtime_ns, st.st_size)
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    async def get(self, filename):
+        """ Returns compiled Job for filename. Compiles if needed. Raises
+            FileNotFoundError et al. when the source can't be read. """
+        st = await self.loop.run_in_executor(None, os.stat, filename)
+        key = self.key(filename, st)
+        future = self.compiling.get(key)
+        if not future:
+            future = self.loop.run_in_executor(None, self.load_or_compile, filename, key)
+            self.compiling[key] = future
+            future.add_done_callback(lambda f: self.compiling.pop(key, None))
+        ## others might be waiting for the same compilation
+        job, compiled = await asyncio.shield(future)
+        if compiled:
+            log.info("Compiled job '{}', {} lines".format(filename, job.lines))
+        return job
+
+    def peek(self, filename):
+        """ Blocking. Returns Job if filename is compiled already, else None """
+        try:
+            key = self.key(filename, os.stat(filename))
+            with open(os.path.join(self.directory, key + '.idx'), 'rb') as fd:
+                return Job.load(None, fd)
+        except OSError:
+            return None
+
+    def sizes(self, filenames):
+        """ Blocking. Maps filenames to their size in bytes after
+            decompression. None if that is unknown. """
+        sizes = {}
+        for filename in filenames:
+            size = None
+            try:
+                if not gcodefile.is_compressed(filename):
+                    size = os.path.getsize(filename)
+                else:
+                    job = self.peek(filename)
+                    if job:
+                        size = job.source_size
+                    elif filename.lower().endswith('.gz'):
+                        size = gcodefile.gzip_size(filename)
+            except OSError:
+                pass
+            sizes[filename] = size
+        return sizes
+
+    def load_or_compile(self, filename, key):
+        """ Runs in executor, no logging here since log handlers might
+            write to client transports. Returns (job, compiled) """
+        base = os.path.join(self.directory, key)
+        try:
+            with open(base + '.idx', 'rb') as fd:
+                job = Job.load(base + '.gcode', fd)
+            if job and os.path.getsize(job.path) == job.size:
+                os.utime(base + '.idx') ## mark as recently used
+                return job, False
+        except FileNotFoundError:
+            pass
+        try:
+            job = compile_job(filename, base + '.tmp')
+            os.replace(base + '.tmp', base + '.gcode')
+            job.path = base + '.gcode'
+            with open(base + '.tmp', 'wb') as fd:
+                job.dump(fd)
+            os.replace(base + '.tmp', base + '.idx')
+        except BaseException:
+            ## eviction only sees complete entries, leave nothing else behind
+            for ext in ('.tmp', '.gcode'):
+                try:
+                    os.remove(base + ext)
+                except FileNotFoundError:
+                    pass
+            raise
+        self.evict(keep=key)
+        return job, True
+
+    def evict(self, keep):
+        """ Runs in executor. Entries currently being streamed are safe to
+            remove, open files stay readable. """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext != '.idx' or key == keep: continue
+            base = os.path.join(self.directory, key)
+            try:
+                size = os.path.getsize(base + '.idx') + os.path.getsize(base + '.gcode')
+                entries.append((os.path.getmtime(base + '.idx'), size, base))
+            except FileNotFoundError:
+                continue
+            total += size
+        try:
+            base = os.path.join(self.directory, keep)
+            total += os.path.getsize(base + '.idx') + os.path.getsize(base + '.gcode')
+        except FileNotFoundError:
+            pass
+        entries.sort()
+        for mtime, size, base in entries:
+            if total <= self.max_size: break
+            for ext in ('.idx', '.gcode'):
+                try:
+                    os.remove(base + ext)
+                except FileNotFoundError:
+                    pass
+            total -= size
@@ -0,0 +1,150 @@
+from bisect import bisect_left
+from collections import deque
+from time import monotonic
+
+## Streaming instrumentation of a device. The sender and receiver report
+## every write and every ack, which is cheap: a few additions and a deque
+## append/pop. All derived numbers are computed when asked for.
+
+## upper edges of the ack round trip time buckets in milliseconds
+RTT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+## The histogram is rolling, it covers between one and two of these periods
+## (seconds).
+HISTOGRAM_PERIOD = 60
+## Send timestamps kept for lines not yet acked. Acks that can't be matched,
+## e.g. lines sent in panic mode, would otherwise grow this forever.
+MAX_INFLIGHT = 1024
+
+class Histogram:
+    def __init__(self, edges=RTT_BUCKETS):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.total = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.edges, value)] += 1
+        self.total += 1
+
+    def merge(self, other):
+        h = Histogram(self.edges)
+        h.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        h.total = self.total + other.total
+        return h
+
+    def percentile(self, p):
+        """ Upper edge of the bucket containing percentile p (0-100). None
+            when empty or when it falls in the overflow bucket. """
+        if not self.total: return None
+        needed = self.total * p / 100
+        seen = 0
+        for edge, count in zip(self.edges, self.counts):
+            seen += count
+            if seen >= needed:
+                return edge
+        return None
+
+    def report(self):
+        labels = ["<={}".format(edge) for edge in self.edges]
+        labels.append(">{}".format(self.edges[-1]))
+        return dict(zip(labels, self.counts))
+
+class Metrics:
+    def __init__(self):
+        self.sent = deque(maxlen=MAX_INFLIGHT)
+        self.writes = 0
+        self.lines = 0
+        self.bytes = 0
+        self.rx_lines = 0
+        self.acks = 0
+        self.current = Histogram()
+        self.previous = Histogram()
+        self.rotated = monotonic()
+        self.last_sample = {}
+        self.reset_interval()
+
+    def reset_interval(self):
+        self.interval_start = monotonic()
+        self.interval_counters = (self.writes, self.lines, self.bytes, self.rx_lines)
+        self.interval_rtt = Histogram()
+        self.depth_samples = 0
+        self.tx_depth_sum = 0
+        self.tx_depth_max = 0
+        self.window_depth_sum = 0
+        self.window_depth_max = 0
+
+    def written(self, lines, nbytes):
+        now = monotonic()
+        self.sent.extend([now] * lines)
+        self.writes += 1
+        self.lines += lines
+        self.bytes += nbytes
+
+    def received(self):
+        self.rx_lines += 1
+
+    def acked(self, tx_depth, window_depth):
+        """ Called for every ack or error. Queue depths are sampled here,
+            that is when they matter. Returns round trip time in ms of the
+            acked line or None if unknown. """
+        now = monotonic()
+        self.acks += 1
+        rtt = None
+        if self.sent:
+            rtt = (now - self.sent.popleft()) * 1000
+            self.current.add(rtt)
+            self.interval_rtt.add(rtt)
+        self.depth_samples += 1
+        self.tx_depth_sum += tx_depth
+        self.window_depth_sum += window_depth
+        if tx_depth > self.tx_depth_max: self.tx_depth_max = tx_depth
+        if window_depth > self.window_depth_max: self.window_depth_max = window_depth
+        if now - self.rotated > HISTOGRAM_PERIOD:
+            self.previous, self.current = self.current, Histogram()
+            self.rotated = now
+        return rtt
+
+    def flush(self):
+        """ Lines in flight are discarded, e.g. on abort """
+        self.sent.clear()
+
+    def rtt(self):
+        return self.previous.merge(self.current)
+
+    def sample(self):
+        """ Rates and averages since the previous call """
+        now = monotonic()
+        elapsed = (now - self.interval_start) or 1
+        writes, lines, nbytes, rx_lines = self.interval_counters
+        samples = self.depth_samples or 1
+        s = {
+            'tx_writes_per_s':  round((self.writes - writes) / elapsed, 1),
+            'tx_lines_per_s':   round((self.lines - lines) / elapsed, 1),
+            'tx_bytes_per_s':   round((self.bytes - nbytes) / elapsed, 1),
+            'rx_lines_per_s':   round((self.rx_lines - rx_lines) / elapsed, 1),
+            'ack_rtt_ms_p50':   self.interval_rtt.percentile(50),
+            'ack_rtt_ms_p95':   self.interval_rtt.percentile(95),
+            'tx_queue_avg':     round(self.tx_depth_sum / samples, 1),
+            'tx_queue_max':     self.tx_depth_max,
+            'window_avg':       round(self.window_depth_sum / samples, 1),
+            'window_max':       self.window_depth_max,
+        }
+        self.reset_interval()
+        self.last_sample = s
+        return s
+
+    def report(self):
+        """ Everything, for the metrics command """
+        rtt = self.rtt()
+        return {
+            'writes':           self.writes,
+            'lines':            self.lines,
+            'bytes':            self.bytes,
+            'rx_lines':         self.rx_lines,
+            'acks':             self.acks,
+            'inflight':         len(self.sent),
+            'ack_rtt_ms':       rtt.report(),
+            'ack_rtt_ms_p50':   rtt.percentile(50),
+            'ack_rtt_ms_p95':   rtt.percentile(95),
+            'ack_rtt_ms_p99':   rtt.percentile(99),
+            'last_interval':    self.last_sample,
+        }
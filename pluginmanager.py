@@ -2,39 +2,57 @@ import logging as log
 import functools
 import traceback
 from collections import defaultdict, namedtuple
+from eventbus import EventQueue, QUEUE_SIZE
 
 Callback = namedtuple('Callback', 'plugin callback')
 Action = namedtuple("Action", "command short_descr long_descr")
 
 pluginmanager = None
 
+## Every function decorated with plugin_hook, by (module, qualname). The
+## PluginManager compiles a call chain for each of them whenever the set of
+## hooks changes. A function that is not hooked by any plugin is left
+## undecorated, calling it costs nothing extra.
+hook_targets = {}
+## targets that currently have at least one hook
+hooked_targets = set()
+
 def plugin_hook(func):
     """ This is a decorator that enables plugins to hook in to this functions"""
-    global pluginmanager
+    hook_targets[(func.__module__, func.__qualname__)] = func
+    return func
+
+def is_hooked(module, qname):
+    """ Allows callers to skip work that only serves plugins """
+    return (module, qname) in hooked_targets
+
+def owner_of(func):
+    """ Object (module or class) that has func as attribute, and its name """
+    import sys
+    obj = sys.modules[func.__module__]
+    path = func.__qualname__.split('.')
+    for name in path[:-1]:
+        obj = getattr(obj, name)
+    return obj, path[-1]
+
+def compile_chain(func, prehooks, posthooks, events):
+    """ Wrap func so it calls the hooks, which are fixed at this point.
+        events are (queue, callback) pairs, published after the posthooks. """
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        qname = func.__qualname__
-        module = func.__module__
-        prehooks, posthooks = pluginmanager.hooks_for(module, qname)
         for hook in prehooks:
-            if not hook.callback: continue
-            log.debug("Function {} was pre hooked by {}".format(qname, hook.plugin.NAME))
             try:
                 await hook.callback(*args, **kwargs)
             except Exception as e:
-                log.error("plugin '{}' crashed.".format(hook.plugin.NAME))
-                log.error(traceback.format_exc())
-                pluginmanager.disable_bad_plugin(hook.plugin)
+                pluginmanager.hook_crashed(hook)
         r = await func(*args, **kwargs)
         for hook in posthooks:
-            if not hook.callback: continue
-            log.debug("Function {} was post hooked by {}".format(qname, hook.plugin.NAME))
             try:
                 await hook.callback(*args, **kwargs)
             except Exception as e:
-                log.error("plugin '{}' crashed.".format(hook.plugin.NAME))
-                log.error(traceback.format_exc())
-                pluginmanager.disable_bad_plugin(hook.plugin)
+                pluginmanager.hook_crashed(hook)
+        for queue, callback in events:
+            queue.publish(callback, args, kwargs)
         return r
     return wrapper
 
@@ -45,11 +63,60 @@ class PluginManager():
         self.gctx = gctx
         self.prehooks = defaultdict(list)
         self.posthooks = defaultdict(list)
+        self.events = defaultdict(list)
+        ## EventQueue per plugin that has EVENTS
+        self.queues = {}
         self.store = gctx['datastore']
 
     def hooks_for(self, module, qname):
         return self.prehooks[(module, qname)], self.posthooks[(module, qname)]
 
+    def compile_hooks(self):
+        """ (Re)install the call chains of all hook targets. Must be called
+            after every change to the hooks. """
+        hooked_targets.clear()
+        for (module, qname), func in hook_targets.items():
+            prehooks = tuple(h for h in self.prehooks.get((module, qname), []) if h.callback)
+            posthooks = tuple(h for h in self.posthooks.get((module, qname), []) if h.callback)
+            events = tuple((self.queues[h.plugin], h.callback)
+                for h in self.events.get((module, qname), []) if h.callback)
+            owner, name = owner_of(func)
+            if not prehooks and not posthooks and not events:
+                setattr(owner, name, func)
+                continue
+            hooked_targets.add((module, qname))
+            for hook in prehooks:
+                log.debug("Function {} is pre hooked by {}".format(qname, hook.plugin.NAME))
+            for hook in posthooks:
+                log.debug("Function {} is post hooked by {}".format(qname, hook.plugin.NAME))
+            for queue, _ in events:
+                log.debug("Function {} publishes events to {}".format(qname, queue.plugin.NAME))
+            setattr(owner, name, compile_chain(func, prehooks, posthooks, events))
+
+    def hook_crashed(self, hook):
+        log.error("plugin '{}' crashed.".format(hook.plugin.NAME))
+        log.error(traceback.format_exc())
+        self.disable_bad_plugin(hook.plugin)
+
+    def event_crashed(self, plugin):
+        log.error("plugin '{}' crashed handling an event.".format(plugin.NAME))
+        log.error(traceback.format_exc())
+        self.disable_bad_plugin(plugin)
+
+    def backlog(self, plugin):
+        """ Number of events published but not yet delivered to plugin """
+        queue = self.queues.get(plugin)
+        return len(queue.pending) if queue else 0
+
+    def dropped(self, plugin):
+        """ Number of events of plugin lost so far """
+        queue = self.queues.get(plugin)
+        return queue.dropped if queue else 0
+
+    def event_stats(self):
+        """ Queue statistics per plugin, to see who is lagging """
+        return {queue.plugin.NAME: queue.report() for queue in self.queues.values()}
+
     def get_handlers(self):
         for plugin in self.gctx["plugins"]:
             for handle in plugin.HANDLES:
@@ -67,6 +134,15 @@ class PluginManager():
         for target, callbacks in instance.POSTHOOKS.items():
             hooks = [Callback(instance, callback) for callback in callbacks]
             self.posthooks[target].extend(hooks)
+        ## events came later, plugins of API version 1 need not know them
+        events = getattr(instance, 'EVENTS', {})
+        for target, callbacks in events.items():
+            hooks = [Callback(instance, callback) for callback in callbacks]
+            self.events[target].extend(hooks)
+        if events:
+            self.queues[instance] = EventQueue(instance, self.event_crashed,
+                getattr(instance, 'EVENT_QUEUE_SIZE', QUEUE_SIZE),
+                getattr(instance, 'EVENT_POLICY', 'drop'))
 
     def disable_bad_plugin(self, plugin):
         if plugin not in self.gctx["plugins"]:
@@ -87,6 +163,14 @@ class PluginManager():
             badhooks = [hook for hook in hooks if hook.plugin == plugin]
             for hook in badhooks:
                 hooks.remove(hook)
+        for target, hooks in self.events.items():
+            badhooks = [hook for hook in hooks if hook.plugin == plugin]
+            for hook in badhooks:
+                hooks.remove(hook)
+        queue = self.queues.pop(plugin, None)
+        if queue:
+            queue.close()
+        self.compile_hooks()
 
     def load_plugins(self):
         general = self.gctx['cfg']["general"]
@@ -118,6 +202,7 @@ class PluginManager():
                 continue
             self.gctx["plugins"].append(instance)
             self.collect_hooks(instance)
+        self.compile_hooks()
 
     def unload_plugins(self):
         for plugin in self.gctx["plugins"]:
@@ -127,5 +212,12 @@ class PluginManager():
                 log.error("Plugin crashed during unloading")
                 log.error(traceback.format_exc())
         self.gctx["plugins"] = []
+        self.prehooks.clear()
+        self.posthooks.clear()
+        self.events.clear()
+        for queue in self.queues.values():
+            queue.close()
+        self.queues.clear()
+        self.compile_hooks()
 
 
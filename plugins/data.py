@@ -6,10 +6,29 @@ class Plugin(SkeletonPlugin):
     NAME = "Data"
     HANDLES = ['data']
 
+    def help(self, cmd):
+        return ("'data HANDLE [--since SEQ]' returns the datastore of HANDLE and "
+            "its sequence number 'seq'. With --since only the keys changed after "
+            "SEQ, or everything with 'full' set when that is too long ago.")
+
     async def handle_command(self, gctx:dict, cctx:dict, lctx) -> None:
         argv = lctx.argv
         if len(argv) <= 1:
             return "need more args"
         handle = argv[1]
-        lctx.write_json({handle: self.datastore.data[handle]})
-
+        data = self.datastore.data[handle]
+        ## large replies, wait for the client to catch up first
+        await lctx.drain()
+        if len(argv) == 2:
+            lctx.write_json({handle: data, 'seq': self.datastore.seq})
+            return
+        if len(argv) != 4 or argv[2] != '--since':
+            return "Expected --since SEQ"
+        try:
+            seq = int(argv[3])
+        except ValueError:
+            return "SEQ must be a number"
+        names = self.datastore.changed_since(handle, seq)
+        if names is not None:
+            data = {name: data[name] for name in names}
+        lctx.write_json({handle: data, 'seq': self.datastore.seq, 'full': names is None})
@@ -0,0 +1,80 @@
+import logging as log
+from plugins.pluginskel import SkeletonPlugin, ConfigPlugin
+from time import time
+from timeseries import TimeSeriesStore, TIERS
+
+## Not every number is worth a history, timestamps, sizes and counters
+## would take the series of those that are.
+KEYS = ['temperature.*', 'progress', 'current_z', 'current_e',
+    'ack_rtt_ms_*', '*_per_s', 'tx_queue_avg', 'window_avg', 'window_size']
+
+class Plugin(SkeletonPlugin, ConfigPlugin):
+
+    PLUGIN_API_VERSION = 1
+    NAME = "History"
+    PREHOOKS = {}
+    POSTHOOKS = {}
+    EVENTS = {}
+    HANDLES = ['history']
+
+    def __init__(self, datastore, gctx:dict):
+        super().__init__(datastore, gctx)
+        ## every value is a sample, nothing coalesced
+        Plugin.EVENTS = {
+            ('datastore', 'DataStore.update'):[self.update],
+        }
+        tiers, max_series, patterns = TIERS, 32, KEYS
+        cfg = self.config('history')
+        if cfg:
+            if 'tiers' in cfg:
+                tiers = [tuple(int(n) for n in tier.split(':'))
+                    for tier in cfg['tiers'].split(',')]
+            max_series = cfg.getint('max_series', fallback=max_series)
+            if 'keys' in cfg:
+                patterns = [key.strip() for key in cfg['keys'].split(',')]
+        self.store = TimeSeriesStore(tiers, max_series, patterns)
+
+    async def update(self, store, devicename, name, value):
+        if isinstance(value, bool):
+            return
+        if isinstance(value, (int, float)):
+            self.store.add(devicename, name, time(), value)
+        elif name == 'temperature':
+            ## list of telemetry.Reading
+            for reading in value:
+                self.store.add(devicename, "temperature.{}".format(reading.sensor),
+                    reading.timestamp, reading.current)
+                if reading.target is not None:
+                    self.store.add(devicename, "temperature.{}.target".format(reading.sensor),
+                        reading.timestamp, reading.target)
+
+    def help(self, cmd):
+        return ("'history DEVICE' lists the recorded keys. 'history DEVICE KEY "
+            "[FROM] [TO] [STEP]' returns the values of KEY from FROM to TO, STEP "
+            "seconds apart. Times are unix timestamps or, when 0 or negative, "
+            "seconds before now. Default the last hour at the finest step available.")
+
+    async def handle_command(self, gctx:dict, cctx:dict, lctx) -> None:
+        argv = lctx.argv
+        if len(argv) < 2:
+            return "specify a device"
+        handle = argv[1]
+        if len(argv) < 3:
+            lctx.write_json({handle: {'keys': self.store.keys(handle)}})
+            return
+        key = argv[2]
+        series = self.store.get(handle, key)
+        if not series:
+            return "no history of '{}'".format(key)
+        ## up to MAX_POINTS values, wait for the client to catch up first
+        await lctx.drain()
+        now = time()
+        try:
+            start, stop, step = [float(a) for a in argv[3:6]] + [-3600., now, 0.][len(argv[3:6]):]
+        except ValueError:
+            return "FROM, TO and STEP must be numbers"
+        if start < 0: start += now
+        if stop <= 0: stop += now
+        first, step, values = series.query(start, stop, step, now)
+        values = [None if v is None else round(v, 3) for v in values]
+        lctx.write_json({handle: {key: {'from': first, 'step': step, 'values': values}}})
@@ -3,6 +3,7 @@ from plugins.pluginskel import SkeletonPlugin, ConfigPlugin
 import os, asyncio, re, concurrent, traceback
 from time import time
 from collections import defaultdict
+from functools import partial
 from requests import post
 from time import time
 
@@ -13,6 +14,9 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
     NAME = "Home Assistant"
     PREHOOKS = {}
     POSTHOOKS = {}
+    EVENTS = {}
+    ## only the latest value of a key is worth sending
+    EVENT_POLICY = 'coalesce'
     HANDLES = []
 
     def __init__(self, datastore, gctx:dict):
@@ -24,6 +28,8 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
             ('robot', 'Device.connect_done'):[self.connect],
             ('robot', 'Device.gcode_open_hook'):[self.gcode_open_hook],
             ('robot', 'Device.gcode_done_hook'):[self.gcode_done_hook],
+        }
+        Plugin.EVENTS = {
             ('datastore', 'DataStore.update'):[self.datastore_update],
         }
         self.ratelimit = {}
@@ -38,21 +44,23 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
     def ha_sanitize(value):
         return value.replace("@", "at")
 
-    def send(self, device, entity, data, binary=False):
+    async def send(self, device, entity, data, binary=False):
         entity = Plugin.ha_sanitize(entity)
         sensor = ["sensor", "binary_sensor"][binary]
         url = f"{self.url}/{sensor}.cncd_{device.handle}_{entity}"
         headers = {"Authorization": f"Bearer {self.token}", "content-type": "application/json"}
         log.info(f"sending {data}")
         try:
-            post(url, headers=headers, json=data)
+            ## blocking HTTP request, keep it away from the event loop
+            await self.gctx['loop'].run_in_executor(None,
+                partial(post, url, headers=headers, json=data))
         except Exception as e:
             log.error(f"Failed to send data to home assistant {e}")
 
-    def send_binary(self, device, entity, data):
-        self.send(device, entity, data, binary=True)
+    async def send_binary(self, device, entity, data):
+        await self.send(device, entity, data, binary=True)
 
-    def send_temperature(self, device, entity, value):
+    async def send_temperature(self, device, entity, value):
         entity = f"temperature_{entity}"
         data = {"attributes":
                   {
@@ -62,7 +70,7 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
                   },
                   "state": value
                 }
-        self.send(device, entity, data)
+        await self.send(device, entity, data)
 
     def ratelimiter(self, handle):
         now = time()
@@ -72,16 +80,15 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
         return False
 
     async def datastore_update(self, datastore, handle, name, value):
-        # we can't do this sens async yet. So better not update to often
-        if name == "temperature_obj":
+        ## Delivered as events. Still rate limited, Home Assistant doesn't
+        ## need every value.
+        if name == "temperature":
             if not self.ratelimiter(f"{handle}_temperature"): return
             device = self.gctx['dev'][handle]
-            for T in value:
-                entity, d = T.split(":")
-                ts = d.split(" /")
-                self.send_temperature(device, f"{entity}", ts[0])
-                if len(ts) > 1:
-                    self.send_temperature(device, f"set_{entity}", ts[1])
+            for reading in value:
+                await self.send_temperature(device, reading.sensor, reading.current)
+                if reading.target is not None:
+                    await self.send_temperature(device, f"set_{reading.sensor}", reading.target)
         elif name == "progress": #filesize
             progress = value
             total = self.datastore.get(handle, "filesize")
@@ -92,7 +99,7 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
                 pct = int(progress/total * 10000)/100
             except ZeroDivisionError:
                 pass
-            self.send(device, "progress", {"state": pct, "attributes":{"state_class":"measurement", "unit_of_measurement":"%"}})
+            await self.send(device, "progress", {"state": pct, "attributes":{"state_class":"measurement", "unit_of_measurement":"%"}})
         else:
             pass
 
@@ -100,17 +107,17 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
         ## I think this is only called on successful connect
         #connected = self.datastore.get(device.handle, "connected")
         #if not connected: return
-        self.send_binary(device, "connected", {"state": "on"})
+        await self.send_binary(device, "connected", {"state": "on"})
 
     async def disconnect(self, device, exc):
-        self.send_binary(device, "connected", {"state": "off"})
+        await self.send_binary(device, "connected", {"state": "off"})
 
     async def gcode_open_hook(self, device, filename):
         fn_s = filename.rfind("/") + 1
         fn_e = filename.rfind(".")
         fn = filename[fn_s:fn_e]
-        self.send(device, "filename", {"state": fn})
-        self.send_binary(device, "active", {"state": "on"})
+        await self.send(device, "filename", {"state": fn})
+        await self.send_binary(device, "active", {"state": "on"})
 
     async def gcode_done_hook(self, device):
-        self.send_binary(device, "active", {"state": "off"})
+        await self.send_binary(device, "active", {"state": "off"})
@@ -40,7 +40,11 @@ class Plugin(SkeletonPlugin):
             else:
                 event = cctx['tracelog_stop_event']
             event.clear()
+            ## a client that is gone doesn't stop
+            on_close = cctx.get('on_close', [])
+            on_close.append(event.set)
             await event.wait()
+            on_close.remove(event.set)
             rootlogger.removeHandler(loghandler)
         else:
             if 'tracelog_stop_event' not in cctx:
@@ -1,5 +1,6 @@
 import logging as log
 from pluginmanager import Callback, Action
+from eventbus import QUEUE_SIZE
 from collections import defaultdict
 
 # SkeletonPlugin has the minimum required functions and properties a plugin
@@ -21,6 +22,9 @@ class SkeletonPlugin():
     NAME = "Skeleton"
     PREHOOKS = {} #of type ('MODULE', 'FUNCTION):[FUNCTION]
     POSTHOOKS = {} #of type ('MODULE', 'FUNCTION):[FUNCTION]
+    EVENTS = {} #of type ('MODULE', 'FUNCTION):[FUNCTION], see eventbus
+    EVENT_QUEUE_SIZE = QUEUE_SIZE
+    EVENT_POLICY = 'drop' #one of eventbus.POLICIES
     PLUGIN_API_VERSION = 0
     HANDLES = [] #of type string
     ACTIONS = [] #of type Action
@@ -1,7 +1,9 @@
 import logging as log
 from plugins.pluginskel import SkeletonPlugin
-import os, re, asyncio
+import os, asyncio, copy
 from time import time
+from gcodefile import GcodeReader
+from gcodestate import ModalState
 
 ## Keeps track of the progress in de gcode file
 ## This plugin should be a model to other plugins and will therefore have
@@ -48,12 +50,10 @@ class Plugin(SkeletonPlugin):
         ## hooked function.
         Plugin.POSTHOOKS = {
             ('robot', 'Device.gcode_open_hook'):[self.open_cb],
-            ('robot', 'Device.gcode_readline_hook'):[self.readline_cb],
+            ('robot', 'Device.gcode_readchunk_hook'):[self.readchunk_cb],
             ('robot', 'Device.gcode_done_hook'):[self.done_cb],
         }
 
-        self.g_pattern = re.compile(r"(?:\s+([XYZEF])\s*(-?\d*(?:\.\d+)?))")
-
     ## Specifically defined for this plugin. However the function signature is
     ## important. The function MUST be defined async. Because CNCD is single
     ## threaded it is super important to NOT DO ANY LONG OPERATIONS here. If
@@ -63,10 +63,10 @@ class Plugin(SkeletonPlugin):
     async def open_cb(self, *args, **kwargs) -> None:
         device, filename = args
         handle = device.handle
-        try:
-            size = os.path.getsize(filename)
-        except FileNotFoundError:
-            size = -1
+        ## By now the device has compiled the job, comments and empty lines
+        ## are gone. Progress is counted in bytes of this compiled form.
+        job = device.job
+        size = job.size
         ## For the datastore the convention is to store all device specific
         ## information with device.handle as key. System wide should
         ## use 'general'
@@ -74,7 +74,8 @@ class Plugin(SkeletonPlugin):
         await self.datastore.update(handle, "stoptime", -1)
         await self.datastore.update(handle, "filename", filename)
         await self.datastore.update(handle, "filesize", size)
-        await self.datastore.update(handle, "progress", 0)
+        ## when continuing a job halfway, count the skipped part as done
+        await self.datastore.update(handle, "progress", device.job_offset)
         self.localstore.update(handle, 'accumulate', 0)
         self.localstore.update(handle, 'last_update', 0)
 
@@ -82,74 +83,35 @@ class Plugin(SkeletonPlugin):
         await self.datastore.update(handle, "current_z", 0)
         await self.datastore.update(handle, "final_e", 1)
         await self.datastore.update(handle, "final_z", 1)
-        self.localstore.update(handle, 'E', 0)
-        self.localstore.update(handle, 'Z', 0)
-        self.localstore.update(handle, 'E_push', 0)
-        self.localstore.update(handle, 'Z_push', 0)
-        self.localstore.update(handle, 'absE', False)
-        self.localstore.update(handle, 'absXYZ', False)
-
-        asyncio.ensure_future(self.analyse_gcode(handle, filename))
-
-    def process_line(self, handle, line, pfx=""):
-        if line.startswith('M82'):
-            self.localstore.update(handle, pfx+'absE', True)
-        elif line.startswith('M83'):
-            self.localstore.update(handle, pfx+'absE', False)
-        elif line.startswith('G90'):
-            self.localstore.update(handle, pfx+'absE', True)
-            self.localstore.update(handle, pfx+'absXYZ', True)
-        elif line.startswith('G91'):
-            self.localstore.update(handle, pfx+'absE', False)
-            self.localstore.update(handle, pfx+'absXYZ', False)
-        elif line.startswith('G0') or line.startswith('G1'):
-            d = self.parseG(self.g_pattern, line)
-            if 'Z' in d:
-                if self.localstore.get(handle, pfx+'absXYZ'):
-                    self.localstore.update(handle, pfx+'Z', d['Z'])
-                else:
-                    self.localstore.inc(handle, pfx+'Z', d['Z'])
-            if 'E' in d:
-                if self.localstore.get(handle, pfx+'absE'):
-                    self.localstore.update(handle, pfx+'E', d['E'])
-                else:
-                    self.localstore.inc(handle, pfx+'E', d['E'])
-        elif line.startswith('G92'):
-            #set absolute positions
-            d = self.parseG(self.g_pattern, line)
-            if 'Z' in d:
-                self.localstore.inc(handle, pfx+'Z_push', self.localstore.get(handle, pfx+'Z'))
-                self.localstore.update(handle, pfx+'Z', d['Z'])
-            if 'E' in d:
-                self.localstore.inc(handle, pfx+'E_push', self.localstore.get(handle, pfx+'E'))
-                self.localstore.update(handle, pfx+'E', d['E'])
-
-    async def analyse_gcode(self, handle, filename):
-        self.localstore.update(handle, 'init_E', 0)
-        self.localstore.update(handle, 'init_Z', 0)
-        self.localstore.update(handle, 'init_E_push', 0)
-        self.localstore.update(handle, 'init_Z_push', 0)
-        self.localstore.update(handle, 'init_absE', False)
-        self.localstore.update(handle, 'init_absXYZ', False)
-        with open(filename) as f:
-            for line in f:
-                l = line.strip()
-                self.process_line(handle, l, pfx="init_")
-                ## This sleep is important since the io above is not actually
-                ## blocking thus the plugin will not yield otherwise.
+        ## Position state is kept in one object rather than a localstore
+        ## key per value, processing a chunk then costs a single lookup. It
+        ## is the same bookkeeping used to continue a job, when continuing
+        ## it starts from the state of the skipped part.
+        state = copy.deepcopy(device.job_state) if device.job_state else ModalState()
+        self.localstore.update(handle, 'state', state)
+
+        asyncio.ensure_future(self.analyse_gcode(handle, job))
+
+    async def analyse_gcode(self, handle, job):
+        state = ModalState()
+        ## The reader does its IO in a thread. Still, hand back control to
+        ## the scheduler after every batch since processing is not async.
+        async with GcodeReader(job.path, self.gctx['loop']) as reader:
+            async for batch in reader:
+                for line in batch:
+                    state.process(line)
                 await asyncio.sleep(0)
-        await self.datastore.update(handle, "final_e", self.localstore.get(handle, 'init_E_push') + self.localstore.get(handle, 'init_E'))
-        await self.datastore.update(handle, "final_z", self.localstore.get(handle, 'init_Z_push') + self.localstore.get(handle, 'init_Z'))
-
-    def parseG(self, pattern, line):
-        d = dict()
-        for dim, val in pattern.findall(line):
-            try:
-                v = float(val)
-            except ValueError:
-                continue
-            d[dim] = v
-        return d
+        await self.datastore.update(handle, "final_e", state.extruded)
+        await self.datastore.update(handle, "final_z", state.height)
+
+    async def flush(self, handle):
+        state = self.localstore.get(handle, 'state')
+        accumulate = self.localstore.get(handle, 'accumulate')
+        self.localstore.update(handle, 'accumulate', 0)
+        progress = self.datastore.get(handle, "progress")
+        await self.datastore.update(handle, "progress", progress+accumulate)
+        await self.datastore.update(handle, "current_z", state.height)
+        await self.datastore.update(handle, "current_e", state.extruded)
 
     async def done_cb(self, *args, **kwargs) -> None:
         device, = args
@@ -158,30 +120,26 @@ class Plugin(SkeletonPlugin):
         ## We only occasionally (2Hz) write progress to the datastore as to
         ## not load the client/CNCD to much. So when we are done we might still
         ## have some information buffered, Flush that.
-        accumulate = self.localstore.get(handle, 'accumulate')
-        progress = self.datastore.get(handle, "progress")
-        await self.datastore.update(handle, "progress", progress+accumulate)
-        await self.datastore.update(handle, "current_z", self.localstore.get(handle, 'Z_push') + self.localstore.get(handle, 'Z'))
-        await self.datastore.update(handle, "current_e", self.localstore.get(handle, 'E_push') + self.localstore.get(handle, 'E'))
+        await self.flush(handle)
 
-    async def readline_cb(self, *args, **kwargs) -> None:
-        device, line = args
+    ## Hooked on the chunk variant of the readline hook: lines holds the next
+    ## few hundred lines to be sent. All bookkeeping happens once per chunk,
+    ## only the G-code itself is looked at line by line.
+    async def readchunk_cb(self, *args, **kwargs) -> None:
+        device, lines = args
         handle = device.handle
-        now = time()
-        ## Assuming each character takes up one byte add lenght of string
-        ## to progress. Only every half a second write to datastore.
-        self.localstore.inc(handle, 'accumulate', len(line))
-        accumulate = self.localstore.get(handle, 'accumulate')
-
-        self.process_line(handle, line.decode())
+        ## Assuming each character takes up one byte add lenght of strings
+        ## plus newlines to progress. Only every half a second write to
+        ## datastore.
+        self.localstore.inc(handle, 'accumulate', sum(map(len, lines)) + len(lines))
+        process = self.localstore.get(handle, 'state').process
+        for line in lines:
+            process(line)
 
+        now = time()
         if now - self.localstore.get(handle, 'last_update') > .5:
             self.localstore.update(handle, 'last_update', now)
-            self.localstore.update(handle, 'accumulate', 0)
-            progress = self.datastore.get(handle, "progress")
-            await self.datastore.update(handle, "progress", progress+accumulate)
-            await self.datastore.update(handle, "current_z", self.localstore.get(handle, 'Z_push') + self.localstore.get(handle, 'Z'))
-            await self.datastore.update(handle, "current_e", self.localstore.get(handle, 'E_push') + self.localstore.get(handle, 'E'))
+            await self.flush(handle)
 
 
     ## Called when user/gui calls a command in HANDLES. Argv is this command
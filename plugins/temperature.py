@@ -1,7 +1,6 @@
 import logging as log
 from plugins.pluginskel import SkeletonPlugin, ConfigPlugin
-import os, asyncio, re, concurrent, traceback
-from time import time
+import os, asyncio, re
 from collections import defaultdict
 
 class Plugin(SkeletonPlugin, ConfigPlugin):
@@ -10,6 +9,7 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
     NAME = "Temperature"
     PREHOOKS = {}
     POSTHOOKS = {}
+    EVENTS = {}
     HANDLES = []
 
     def __init__(self, datastore, gctx:dict):
@@ -19,61 +19,67 @@ class Plugin(SkeletonPlugin, ConfigPlugin):
         }
         Plugin.POSTHOOKS = {
             ('robot', 'Device.connect_done'):[self.connect],
-            ('robot', 'Device.rx_hook'):[self.incoming],
         }
-        self.tasks_by_handle = {}
-        self.tmp_pttrn = re.compile(r"[^\s:]+:\d+(?:\.\d+)?(?: /\d+(?:\.\d+)?)?")
+        ## Responses parsed by the device, handled off the receive path
+        Plugin.EVENTS = {
+            ('robot', 'Device.temperature_hook'):[self.temperatures],
+            ('robot', 'Device.position_hook'):[self.position],
+        }
 
         cfg = self.config('temperature')
         self.blacklist = []
+        ## seconds between reports
+        self.interval = 3
+        ## seconds between position reports, 0 for none
+        self.position_interval = 0
+        ## let the firmware report by itself when it can
+        self.autoreport = True
         if cfg:
             try:
                 self.blacklist = [i.strip() for i in cfg['blacklist'].split(',')]
             except KeyError:
                 pass ## not configured, all devices are okay
+            self.interval = cfg.getint('interval', fallback=self.interval)
+            self.position_interval = cfg.getint('position_interval',
+                fallback=self.position_interval)
+            self.autoreport = cfg.getboolean('autoreport', fallback=self.autoreport)
     
-    def poll_cb(self, future):
-        """Generic callback for tasks"""
-        try:
-            r = future.result()
-        except concurrent.futures._base.CancelledError:
-            pass
-        except Exception as e:
-            log.critical(str(e))
-            log.critical(traceback.format_exc())
-
-    async def poll(self, device):
-        handle = device.handle
-        while True:
-            if not await device.inject('M105'):
-                log.warning("Sending time probe failed. Backing off")
-                break
-            await self.datastore.update(handle, "last_temp_request", time())
-            await asyncio.sleep(3)
-
     async def connect(self, device):
         handle = device.handle
         if handle in self.blacklist: return
-        if handle in self.tasks_by_handle:
-            return
         connected = self.datastore.get(handle, "connected")
         if not connected:
             return
-        await self.datastore.update(handle, "last_temp_request", 0)
-        await asyncio.sleep(2) ## give the device some time to start
-        task = asyncio.ensure_future(self.poll(device))
-        task.add_done_callback(self.poll_cb)
-        ## TODO add exception handler
-        self.tasks_by_handle[handle] = task
+        ## capabilities might differ since the last connect
+        device.queries.unregister(self)
+        caps = device.capabilities if self.autoreport else {}
+        if not self.position_interval:
+            pass
+        elif caps.get('AUTOREPORT_POS'):
+            device.inject_nowait('M154 S{}'.format(self.position_interval))
+        else:
+            device.queries.register(self, 'M114', self.position_interval, -1)
+        if caps.get('AUTOREPORT_TEMP'):
+            ## no polling traffic in between the job
+            log.info("Device '{}' reports temperatures by itself".format(handle))
+            device.inject_nowait('M155 S{}'.format(self.interval))
+        else:
+            device.queries.register(self, 'M105', self.interval)
 
     async def disconnect(self, device, exc):
-        task = self.tasks_by_handle.pop(device.handle, None)
-        if task:
-            task.cancel()
+        device.queries.unregister(self)
 
-    async def incoming(self, device, response):
+    def close(self):
+        for device in self.gctx['dev'].values():
+            device.queries.unregister(self)
+
+    async def temperatures(self, device, response):
         handle = device.handle
-        groups = self.tmp_pttrn.findall(response)
-        if groups:
-            await self.datastore.update(handle, "temperature", str(groups))
-            await self.datastore.update(handle, "temperature_obj", groups)
+        readings = response.fields['sensors']
+        if readings:
+            await self.datastore.update(handle, "temperature", readings)
+
+    async def position(self, device, response):
+        fields = response.fields
+        pos = {axis: fields[axis] for axis in 'XYZE' if fields[axis] is not None}
+        await self.datastore.update(device.handle, "position", pos)
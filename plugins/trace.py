@@ -1,8 +1,77 @@
 import logging as log
 from plugins.pluginskel import SkeletonPlugin
-import os, asyncio
+import os, asyncio, json
 from time import time
-from collections import defaultdict
+from fnmatch import fnmatchcase
+
+class Subscription:
+    """ Updates of devices matching handle, keys matching any of patterns
+        or all keys when there are none. With an interval updates are
+        collected and sent as one message per interval, latest value per
+        key. Updates for a client that can't keep up (writable cleared)
+        are collected the same way until it caught up. """
+    def __init__(self, handle, patterns, lctx, interval, datastore, synced, writable):
+        self.handle = handle
+        self.datastore = datastore
+        self.synced = synced
+        self.patterns = patterns
+        self.lctx = lctx
+        self.interval = interval
+        self.writable = writable
+        self.event = asyncio.Event()
+        self.pending = {}
+        self.timer = None
+        self.waiter = None
+        ## events the plugin lost before this subscription started
+        self.dropped = 0
+
+    def deferred(self):
+        """ True when updates must be collected rather than written """
+        return self.interval or self.pending or not self.writable.is_set()
+
+    def add(self, devicename, name, value):
+        self.pending.setdefault(devicename, {})[name] = value
+        if self.timer or self.waiter:
+            return
+        if self.interval:
+            loop = asyncio.get_event_loop()
+            self.timer = loop.call_later(self.interval, self.flush)
+        else:
+            self.waiter = asyncio.ensure_future(self.resume())
+
+    async def resume(self):
+        await self.writable.wait()
+        self.waiter = None
+        self.flush()
+
+    def flush(self):
+        self.timer = None
+        if self.pending and not self.writable.is_set():
+            ## the client is behind, keep merging changes until it caught up
+            if not self.waiter:
+                self.waiter = asyncio.ensure_future(self.resume())
+            return
+        self.write()
+
+    def write(self):
+        pending, self.pending = self.pending, {}
+        if pending:
+            if self.synced(self):
+                pending['seq'] = self.datastore.seq
+            self.lctx.write_json(pending)
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+        if self.waiter:
+            self.waiter.cancel()
+            self.waiter = None
+        self.write()
+
+    def matches(self, devicename, name):
+        if not fnmatchcase(devicename, self.handle):
+            return False
+        return not self.patterns or any(fnmatchcase(name, p) for p in self.patterns)
 
 class Plugin(SkeletonPlugin):
 
@@ -10,38 +79,107 @@ class Plugin(SkeletonPlugin):
     NAME = "Data Subscriber"
     PREHOOKS = {}
     POSTHOOKS = {}
+    EVENTS = {}
+    ## A subscriber wants the latest value of every key, intermediate values
+    ## can be skipped when clients can't keep up.
+    EVENT_POLICY = 'coalesce'
+    EVENT_QUEUE_SIZE = 1024
     HANDLES = ['subscribe', 'unsubscribe']
 
     def __init__(self, datastore, gctx:dict):
         super().__init__(datastore, gctx)
-        Plugin.POSTHOOKS = {
+        Plugin.EVENTS = {
             ('datastore', 'DataStore.update'):[self.update],
         }
-        self.handles = defaultdict(dict)
+        ## (connection, handle) -> Subscription
+        self.subscriptions = {}
+        ## (devicename, key) -> matching subscriptions, filled on first use
+        ## and emptied whenever the subscriptions change
+        self.lookup = {}
+
+    def synced(self, subscription):
+        """ True when every update so far got here and none was lost
+            since subscription started. Messages then carry the sequence
+            number of the datastore, a client that lost its connection can
+            catch up with 'data HANDLE --since SEQ'. """
+        backlog, dropped = self.queue_state()
+        return not backlog and dropped == subscription.dropped
+
+    def queue_state(self):
+        """ Events pending and lost so far """
+        manager = self.gctx.get('pluginmanager')
+        if not manager: return 0, 0
+        return manager.backlog(self), manager.dropped(self)
+
+    def subscribers(self, devicename, name):
+        return [s for s in self.subscriptions.values() if s.matches(devicename, name)]
 
     async def update(self, store, devicename, name, value):
-        listeners_for_handle = self.handles[devicename]
-        for con, (event, write_json) in listeners_for_handle.items():
-            write_json({devicename:{name:value}})
+        key = (devicename, name)
+        subscriptions = self.lookup.get(key)
+        if subscriptions is None:
+            subscriptions = self.lookup[key] = self.subscribers(devicename, name)
+        ## encoded once for everyone, with and without seq
+        lines = {}
+        backlog = None
+        for subscription in subscriptions:
+            if subscription.deferred():
+                subscription.add(devicename, name, value)
+                continue
+            if backlog is None:
+                backlog, dropped = self.queue_state()
+            synced = not backlog and subscription.dropped == dropped
+            line = lines.get(synced)
+            if line is None:
+                msg = {devicename:{name:value}}
+                if synced:
+                    msg['seq'] = store.seq
+                line = lines[synced] = (json.dumps(msg) + '\n').encode()
+            subscription.lctx.write_encoded(line)
+
+    def help(self, cmd):
+        if cmd == 'subscribe':
+            return ("'subscribe HANDLE [KEY ...] [--interval SECONDS]' sends "
+                "every update of the datastore for HANDLE until unsubscribed. "
+                "HANDLE may be * or a glob to cover several devices, KEYs are "
+                "globs to limit the keys sent. With an interval the changes are "
+                "sent at most once per interval, in one message with the latest "
+                "value per key. Subscribing again to the same HANDLE replaces "
+                "the keys and interval. Messages carry the datastore's 'seq' "
+                "while no update got lost since subscribing, once it is missing "
+                "subscribe again and fetch the data with 'data HANDLE'.")
+        return "'unsubscribe HANDLE' stops the subscription to HANDLE"
 
     async def handle_command(self, gctx:dict, cctx:dict, lctx) -> None:
         argv = lctx.argv
         if len(argv) < 2:
             return "specify what to subscribe to"
-        handle = argv[1]
-        listeners_for_handle = self.handles[handle]
-        key = cctx['transport']
+        patterns, interval = argv[2:], 0
+        if '--interval' in patterns:
+            i = patterns.index('--interval')
+            try:
+                interval = float(patterns[i+1])
+            except (IndexError, ValueError):
+                return "--interval needs a number of seconds"
+            if interval < 0:
+                return "--interval must not be negative"
+            patterns = patterns[:i] + patterns[i+2:]
+        key = (cctx['transport'], argv[1])
+        previous = self.subscriptions.pop(key, None)
+        if previous:
+            previous.event.set()
+        self.lookup.clear()
         if argv[0] == 'subscribe':
-            if key in listeners_for_handle:
-                event, writeln = listeners_for_handle[key]
-                event.set()
-            event = asyncio.Event()
-            listeners_for_handle[key] = (event, lctx.write_json)
-            event.clear()
-            await event.wait()
-            listeners_for_handle.pop(key)
-        else:
-            if key in listeners_for_handle:
-                event, writeln = listeners_for_handle[key]
-                event.set()
-
+            subscription = Subscription(argv[1], patterns, lctx, interval,
+                self.datastore, self.synced, cctx['writable'])
+            subscription.dropped = self.queue_state()[1]
+            self.subscriptions[key] = subscription
+            ## a client that is gone doesn't unsubscribe
+            on_close = cctx.get('on_close', [])
+            on_close.append(subscription.event.set)
+            await subscription.event.wait()
+            on_close.remove(subscription.event.set)
+            if self.subscriptions.get(key) is subscription:
+                del self.subscriptions[key]
+                self.lookup.clear()
+            subscription.close()
@@ -0,0 +1,126 @@
+import logging as log
+import asyncio
+from time import monotonic
+
+## Periodic status queries (M105, M114, M27, ...) of a device. Plugins
+## register the queries they need, consumers of the same gcode share one
+## request at the shortest interval asked for. A due query is handed to the
+## sender which puts it in the next free slot of the window, ahead of the
+## job. At most one query waits for the sender at a time.
+
+## Dense motion, a job is streaming and the window is full: queries of
+## priority 0 and lower are sent this many times less often.
+DENSE_SLOWDOWN = 4
+## seconds between checks whether the motion is still dense
+RECHECK = 1
+
+class Query:
+    """ One gcode and everyone interested in it """
+    def __init__(self, gcode):
+        self.gcode = gcode
+        ## consumer -> (interval, priority)
+        self.consumers = {}
+        self.interval = None
+        self.priority = 0
+        ## time last handed to the sender
+        self.last = 0
+
+    def update(self):
+        self.interval = min(i for i, p in self.consumers.values())
+        self.priority = max(p for i, p in self.consumers.values())
+
+class QueryScheduler:
+    def __init__(self, device):
+        self.device = device
+        self.queries = {}
+        ## due query the sender should send next
+        self.waiting = None
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def register(self, consumer, gcode, interval, priority=0):
+        """ Send gcode every interval seconds for consumer. Higher priority
+            queries go first and are not slowed down by dense motion when
+            above 0. Registering again changes interval and priority. """
+        query = self.queries.get(gcode)
+        if not query:
+            query = self.queries[gcode] = Query(gcode)
+        query.consumers[consumer] = (interval, priority)
+        query.update()
+        self.changed.set()
+
+    def unregister(self, consumer, gcode=None):
+        """ Stop gcode, or every query of consumer when None """
+        for query in list(self.queries.values()):
+            if gcode is not None and query.gcode != gcode: continue
+            if query.consumers.pop(consumer, None) is None: continue
+            if query.consumers:
+                query.update()
+                continue
+            del self.queries[query.gcode]
+            if self.waiting is query:
+                self.waiting = None
+        self.changed.set()
+
+    def report(self):
+        return {gcode: {'interval': q.interval, 'priority': q.priority,
+            'consumers': len(q.consumers)} for gcode, q in self.queries.items()}
+
+    def dense(self):
+        device = self.device
+        return device.file_task is not None and \
+            len(device.window) >= device.window.size
+
+    def pick(self, now):
+        """ Most important due query and the seconds until the next one
+            is due """
+        dense = self.dense()
+        best, wait = None, None
+        for query in self.queries.values():
+            interval = query.interval
+            if dense and query.priority <= 0:
+                interval *= DENSE_SLOWDOWN
+            left = query.last + interval - now
+            if left <= 0:
+                if best is None or query.priority > best.priority:
+                    best = query
+            elif wait is None or left < wait:
+                wait = left
+        if dense and wait is not None:
+            wait = min(wait, RECHECK)
+        return best, wait
+
+    def take(self):
+        """ Called by the sender when it is about to send a line, returns
+            the gcode of the waiting query """
+        query, self.waiting = self.waiting, None
+        if not query: return None
+        query.last = monotonic()
+        self.changed.set()
+        return query.gcode
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            wait = None
+            if not self.waiting:
+                query, wait = self.pick(monotonic())
+                if query:
+                    self.waiting = query
+                    wait = None
+                    self.device.wake_sender()
+            try:
+                await asyncio.wait_for(self.changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.waiting = None
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def stop(self):
+        self.waiting = None
+        if self.task:
+            self.task.cancel()
+            self.task = None
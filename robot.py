@@ -4,23 +4,26 @@ import serial
 import serial_asyncio
 import os, re, traceback
 
-from pluginmanager import plugin_hook
-import flavour
-
-class DummySerialConnection():
-    def __init__(self, device, rx_queue):
-        self.rx_queue = rx_queue
-        self.device = device
-        device.set_protocol(self)
-        self.write("> Dummy console")
-    def close(self):
-        log.info("Dummy serial connection closed")
-        asyncio.ensure_future(self.device.disconnect_done(None))
-    def write(self, msg):
-        async def slow_ack():
-            await asyncio.sleep(.01)
-            await self.rx_queue.put("ok\n")
-        task = asyncio.ensure_future(slow_ack())
+from pluginmanager import plugin_hook, is_hooked
+import flavour, gcodefile, flowcontrol, metrics, simulator, queries
+
+## Lines buffered between the job reader and the sender. Must be large enough
+## to fill the window of the firmware in one go.
+TX_QUEUE_SIZE = 32
+## seconds between updates of the streaming metrics in the datastore
+METRICS_INTERVAL = 1
+## maximum number of lines passed to gcode_readchunk_hook at once
+HOOK_CHUNK = 256
+## plugin hook per kind of response, see flavour.DIALECTS
+RESPONSE_HOOKS = {
+    'temperature':  'temperature_hook',
+    'position':     'position_hook',
+    'status':       'status_hook',
+    'alarm':        'alarm_hook',
+    'echo':         'echo_hook',
+}
+## seconds to wait for the capability report of the firmware at connect
+PROBE_TIMEOUT = 2
 
 class CncConnection(asyncio.Protocol):
     """Implements protocol"""
@@ -30,8 +33,18 @@ class CncConnection(asyncio.Protocol):
         self.device = device
         device.set_protocol(self)
         self.input_buffer = ""
+        self.can_write = asyncio.Event()
+        self.can_write.set()
     def connection_made(self, transport):
         self.transport = transport
+    def pause_writing(self):
+        self.can_write.clear()
+    def resume_writing(self):
+        self.can_write.set()
+    async def drain(self):
+        """ Wait until the write buffer of the transport is below its low
+            water mark """
+        await self.can_write.wait()
     def data_received(self, data):
         self.input_buffer += data.decode()
         while True:
@@ -56,7 +69,18 @@ class Device():
         self.ev_connected = asyncio.Event()
 
         self.file_task = None
+        self.job = None
+        ## set when the job starts halfway, see start()
+        self.job_offset = 0
+        self.job_state = None
         self.panic_mode = False
+        self.metrics = metrics.Metrics()
+        ## reported by the firmware at connect, see probe_capabilities()
+        self.capabilities = {}
+        self.firmware_info = {}
+        self.probe = None
+        ## periodic status queries registered by plugins
+        self.queries = queries.QueryScheduler(self)
 
         self.firmware = flavour.get_firmware(self.cfg.get('firmware', 'generic'))
         asyncio.ensure_future(self.store('paused', False))
@@ -76,8 +100,14 @@ class Device():
         if self.ev_connected.is_set():
             log.warning("already connected")
             return False
-        self.ack_queue = asyncio.Queue(self.firmware.max_buffer_lenght)
-        self.tx_queue = asyncio.Queue(1)
+        self.window = flowcontrol.get_window(self.cfg, self.firmware)
+        self.window_control = flowcontrol.get_controller(self.cfg, self.window)
+        self.resend_buffer = None
+        if self.cfg.getboolean('checksum', fallback=False):
+            size = self.cfg.getint('resend_buffer', fallback=256)
+            self.resend_buffer = flowcontrol.ResendBuffer(size)
+        self.tx_queue = asyncio.Queue(TX_QUEUE_SIZE)
+        self.metrics = metrics.Metrics()
         rx_queue = asyncio.Queue()
         is_alive = asyncio.Event()
 
@@ -118,7 +148,7 @@ class Device():
         ev_done = asyncio.Event()
         loop = self.gctx['loop']
         if proto == 'dummy':
-            DummySerialConnection(self, rx_queue)
+            simulator.simulate(self, rx_queue, addr, int(param), self.cfg)
             ev_done.set()
             self.ev_connected.set()
         elif proto == 'serial':
@@ -141,10 +171,13 @@ class Device():
             return False
         await self.store('connected', True)
 
-        self.tx_task = asyncio.ensure_future(self.sender(self.tx_queue, self.ack_queue, is_alive))
+        self.tx_task = asyncio.ensure_future(self.sender(self.tx_queue, self.window, is_alive))
         self.tx_task.add_done_callback(self.task_done)
-        self.rx_task = asyncio.ensure_future(self.receiver(rx_queue, self.ack_queue, is_alive))
+        self.rx_task = asyncio.ensure_future(self.receiver(rx_queue, self.window, is_alive))
         self.rx_task.add_done_callback(self.task_done)
+        self.metrics_task = asyncio.ensure_future(self.report_metrics())
+        self.metrics_task.add_done_callback(self.task_done)
+        self.queries.start().add_done_callback(self.task_done)
         return True
 
     def task_done(self, future):
@@ -179,40 +212,194 @@ class Device():
         self.ev_connected.clear()
         self.tx_task.cancel()
         self.rx_task.cancel()
+        self.metrics_task.cancel()
+        self.queries.stop()
         self.protocol.close()
         return True
 
-    async def sender(self, tx_queue, ack_queue, is_alive):
+    async def sender(self, tx_queue, window, is_alive):
         log.debug("waiting for alive")
         await is_alive.wait()
+        if self.firmware.capability_report and \
+                self.cfg.getboolean('detect_capabilities', fallback=True):
+            await self.probe_capabilities(window)
         await self.connect_done()
         log.debug("start sender")
+        resend = self.resend_buffer
+        scheduled = self.queries
+        held = None
+        if resend:
+            ## line 0, reset line numbering of the firmware
+            held = ('M110', False)
+        ## Lines are collected in pending and written in one go right before
+        ## the sender would block. Thus when the window allows several lines
+        ## in flight they end up in a single write.
+        pending = []
+        pending_queued = 0
+        async def flush():
+            nonlocal pending, pending_queued
+            if not pending: return
+            data = ''.join(pending)
+            self.protocol.write(data)
+            self.metrics.written(len(pending), len(data))
+            for _ in range(pending_queued):
+                tx_queue.task_done()
+            pending = []
+            pending_queued = 0
+            ## transport is congested, e.g. a stalled TCP connection
+            await self.protocol.drain()
         while True:
-            line = await tx_queue.get()
+            if resend and resend.replay:
+                out = resend.replay.popleft()
+                if not window.fits(out): await flush()
+                await window.acquire(out)
+                log.debug("Resending: '{}'".format(out))
+                pending.append(out+'\n')
+                continue
+            if held:
+                (line, queued), held = held, None
+            elif scheduled.waiting:
+                line, queued = scheduled.take(), False
+            else:
+                if tx_queue.empty(): await flush()
+                line, queued = await tx_queue.get(), True
+                if line is None: ## woken up to replay or query
+                    tx_queue.task_done()
+                    continue
+            if not self.ev_resume.is_set(): await flush()
             await self.ev_resume.wait()
+            out = line
             if not self.panic_mode:
-                await ack_queue.put(line)
-            log.debug("Outgoing: '{}'".format(line))
-            self.protocol.write(line+'\n')
-            self.tx_queue.task_done()
+                if resend:
+                    out = resend.format(line)
+                if not window.fits(out): await flush()
+                await window.acquire(out)
+                if resend:
+                    if resend.replay:
+                        ## a resend was requested while we waited, do that first
+                        window.cancel(out)
+                        held = (line, queued)
+                        continue
+                    resend.commit(out)
+            log.debug("Outgoing: '{}'".format(out))
+            pending.append(out+'\n')
+            pending_queued += queued
+
+    async def probe_capabilities(self, window):
+        """ Ask the firmware what it supports (M115) before anything else
+            is sent. Plugins find the result in self.capabilities when
+            connect_done is called. """
+        self.capabilities = {}
+        self.firmware_info = {}
+        self.probe = asyncio.Event()
+        query = self.firmware.capability_report
+        await window.acquire(query)
+        self.protocol.write(query + '\n')
+        self.metrics.written(1, len(query) + 1)
+        try:
+            await asyncio.wait_for(self.probe.wait(), PROBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.info("Device '{}' did not report its capabilities".format(self.get_name()))
+            ## Carry on without them. The query keeps its slot in the window,
+            ## a late ack releases it like that of any other line.
+        self.probe = None
+        log.debug("Device '{}' capabilities: {}".format(self.get_name(), self.capabilities))
+        await self.store('firmware', self.firmware_info.get('FIRMWARE_NAME', ''))
+        await self.store('capabilities', dict(self.capabilities))
+
+    def probe_response(self, response):
+        """ Collect the capability report, done at its ack """
+        kind = response.kind
+        if kind == 'firmware':
+            self.firmware_info.update(response.fields['info'])
+        elif kind == 'capability':
+            self.capabilities[response.fields['name']] = response.fields['value']
+        if response.ack or kind == 'error':
+            self.probe.set()
+
+    async def report_metrics(self):
+        """ Periodically publish streaming metrics to the datastore """
+        last = {}
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            sample = self.metrics.sample()
+            sample['window_size'] = self.window.size
+            for key, value in sample.items():
+                if last.get(key) == value: continue
+                last[key] = value
+                await self.store(key, value)
 
     @plugin_hook
     async def rx_hook(self, line):
+        """ Every received line. Prefer the hooks per kind of response
+            below, the line is parsed already. """
+        pass
+
+    @plugin_hook
+    async def temperature_hook(self, response):
+        """ response.fields['sensors'] """
+        pass
+
+    @plugin_hook
+    async def position_hook(self, response):
+        """ response.fields X, Y, Z and E """
+        pass
+
+    @plugin_hook
+    async def status_hook(self, response):
+        """ Grbl status report, response.fields state and report """
         pass
 
-    async def receiver(self, rx_queue, ack_queue, is_alive):
+    @plugin_hook
+    async def alarm_hook(self, response):
+        """ Grbl alarm, response.fields['code']. Not an answer to a line,
+            no line is released from the window. """
+        log.warning("Device '{}' raised alarm {}".format(self.get_name(), response.fields['code']))
+
+    @plugin_hook
+    async def echo_hook(self, response):
+        """ response.fields['text'] """
+        pass
+
+    async def receiver(self, rx_queue, window, is_alive):
+        classify = self.firmware.classify
         while True:
-            line = self.firmware.strip_prompt(await rx_queue.get())
+            response = classify(await rx_queue.get())
+            line = response.line
             await self.rx_hook(line)
+            kind = response.kind
+            hook = RESPONSE_HOOKS.get(kind)
+            if hook:
+                await getattr(self, hook)(response)
             log.debug("Incoming: '{}'".format(line))
+            self.metrics.received()
             is_alive.set()
-            if self.firmware.is_ack(line):
-                if not ack_queue.empty():
-                    _ = await ack_queue.get()
-            elif self.firmware.is_error(line):
-                if not ack_queue.empty():
-                    _ = await ack_queue.get()
-
+            if self.probe:
+                self.probe_response(response)
+            if kind == 'resend' and self.resend_buffer:
+                self.request_resend(response.fields['line'], window)
+            control = self.window_control
+            if response.ack:
+                rtt = self.metrics.acked(self.tx_queue.qsize(), len(window))
+                window.release()
+                if control: control.acked(rtt)
+            elif kind == 'error':
+                self.metrics.acked(self.tx_queue.qsize(), len(window))
+                window.release()
+                if control: control.error()
+            elif control and kind == 'busy':
+                control.busy()
+
+    def request_resend(self, n, window):
+        if not self.resend_buffer.request(n, len(window)):
+            log.error("Device '{}' requested resend of line {} which is no longer buffered".format(self.get_name(), n))
+            return
+        self.wake_sender()
+
+    def wake_sender(self):
+        """ The sender might be waiting for new lines, nudge it. """
+        if not self.tx_queue.full():
+            self.tx_queue.put_nowait(None)
 
     async def inject(self, gcode):
         if not self.ev_connected.is_set():
@@ -221,34 +408,71 @@ class Device():
         await self.tx_queue.put(gcode)
         return True
 
+    def inject_nowait(self, gcode):
+        """ inject for hooks that run inside the sender, like connect_done.
+            The sender is the only consumer of tx_queue, waiting there for
+            room would never end. When the queue is full the line is put
+            by a task of its own. """
+        if not self.ev_connected.is_set():
+            log.warning("not connected")
+            return False
+        if self.tx_queue.full():
+            asyncio.ensure_future(self.tx_queue.put(gcode))
+        else:
+            self.tx_queue.put_nowait(gcode)
+        return True
+
     @plugin_hook
     async def gcode_open_hook(self, filename):
         log.info("Device '{}' starts working on file '{}'".format(self.get_name(), filename))
         return filename
 
+    @plugin_hook
+    async def gcode_readchunk_hook(self, lines):
+        """ lines is a list of the next lines about to be sent """
+        return lines
+
     @plugin_hook
     async def gcode_readline_hook(self, line):
+        """ Deprecated, per line variant of gcode_readchunk_hook. Only
+            called when some plugin hooks it. As it always did line is
+            bytes ending in a newline, the G-code of the job without its
+            comments. """
         return line
 
     @plugin_hook
     async def gcode_done_hook(self):
         log.info("Device '{}' stopped working on file".format(self.get_name()))
 
-    async def start_task(self, filename):
-        def strip_comments(line):
-            line = line.decode()
-            idx = line.find(';')
-            if idx < 0:
-                return line.strip()
-            else:
-                return line[:idx].strip()
-
+    async def start_task(self, filename, line, layer):
         await self.store('idle', False)
-        with open(await self.gcode_open_hook(filename), 'rb') as fd:
-            for line in fd:
-                line = strip_comments(await self.gcode_readline_hook(line))
-                if not line: continue
-                await self.tx_queue.put(line)
+        loop = self.gctx['loop']
+        ## stripped once, reused for every start of the same file
+        job = await self.gctx['jobcache'].get(filename)
+        if layer is not None:
+            line = job.layer_line(layer)
+        elif line:
+            ## the user counts lines of the file, not of the compiled job
+            line = await loop.run_in_executor(None, job.source_line, filename, line)
+        offset, state = 0, None
+        if line:
+            offset, state = await loop.run_in_executor(None, job.scan, line)
+            log.info("Device '{}' continues at G-code line {}".format(self.get_name(), line))
+        self.job, self.job_offset, self.job_state = job, offset, state
+        filename = await self.gcode_open_hook(filename)
+        if state:
+            for gcode in state.preamble():
+                await self.tx_queue.put(gcode)
+        async with gcodefile.GcodeReader(job.path, loop, offset) as reader:
+            async for batch in reader:
+                for i in range(0, len(batch), HOOK_CHUNK):
+                    chunk = batch[i:i+HOOK_CHUNK]
+                    await self.gcode_readchunk_hook(chunk)
+                    per_line = is_hooked('robot', 'Device.gcode_readline_hook')
+                    for line in chunk:
+                        if per_line:
+                            await self.gcode_readline_hook((line + '\n').encode())
+                        await self.tx_queue.put(line)
         log.info("Device '{}' stops working on file '{}'".format(self.get_name(), filename))
 
     def start_task_cb(self, future):
@@ -256,20 +480,28 @@ class Device():
             r = future.result()
         except FileNotFoundError:
             log.warning("File not found")
+        except ValueError as e:
+            log.error("Can't start job: {}".format(e))
         except concurrent.futures._base.CancelledError:
             log.debug('start task cancelled')
         finally:
             self.file_task = None
             asyncio.ensure_future(self.store('idle', True))
-            asyncio.ensure_future(self.gcode_done_hook())
-
-    async def start(self, filename):
+            ## only when the open hook got called
+            if self.job:
+                self.job = None
+                asyncio.ensure_future(self.gcode_done_hook())
+
+    async def start(self, filename, line=0, layer=None):
+        """ Start streaming filename. Optionally continue at a line of
+            filename (counted from 1) or layer, the modal state (temperatures, fan, E position, etc) is
+            restored from the part that is skipped. """
         if not self.ev_connected.is_set():
             log.warning("not connected")
             return False
         if self.file_task: return False
         await self.resume()
-        self.file_task = asyncio.ensure_future(self.start_task(filename))
+        self.file_task = asyncio.ensure_future(self.start_task(filename, line, layer))
         self.file_task.add_done_callback(self.start_task_cb)
         return True
 
@@ -299,7 +531,10 @@ class Device():
             return False
         log.warning("Device '{}' aborting".format(self.get_name()))
         self.flush_queue(self.tx_queue)
-        self.flush_queue(self.ack_queue)
+        self.window.flush()
+        self.metrics.flush()
+        if self.resend_buffer:
+            self.resend_buffer.flush()
         if self.file_task:
             self.file_task.cancel()
         self.panic_mode = True
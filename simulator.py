@@ -0,0 +1,469 @@
+import logging as log
+import asyncio, math, random, re, traceback
+from collections import deque
+import flowcontrol, gcodestate
+
+## Simulated firmware behind the dummy:// port scheme, e.g.
+## dummy://marlin:115200. It stands in for the serial connection and behaves
+## like a machine running that firmware: bytes arrive at the baud rate in a
+## receive buffer of limited size, complete lines go to a small command
+## buffer, moves are planned and take the time their feedrate says, heaters
+## heat up and M109/M190 wait for them. Meant for benchmarks and testing of
+## the streaming code without tying up real machines.
+##
+## Device configuration, all optional:
+##   sim_speedup      run the machine this many times faster than real time
+##   sim_rx_buffer    receive buffer in bytes, default from dialect
+##   sim_planner      planner queue in moves, default from dialect
+##   sim_resend_rate  fraction of numbered lines rejected with a resend
+##   sim_noise_rate   fraction of lines corrupted on the wire
+##   sim_wait         send 'wait' when idle, like Marlin with NO_TIMEOUTS
+##   sim_seed         seed for the random faults, for reproducible runs
+
+AMBIENT = 21.
+## seconds between keepalive messages while a command blocks
+KEEPALIVE = 2.
+## feedrate in mm/min when the job never set one
+DEFAULT_FEEDRATE = 1500.
+## time to home all axes in seconds
+HOMING_TIME = 5.
+NUMBERED = re.compile(r"^N(\d+)\s*(.*)\*(\d+)$")
+
+class Heater:
+    """ Heats and cools at a fixed rate in degrees per second """
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+        self.current = AMBIENT
+        self.target = 0.
+
+    def step(self, dt):
+        goal = self.target or AMBIENT
+        delta = goal - self.current
+        if abs(delta) <= self.rate * dt:
+            self.current = goal
+        else:
+            self.current += math.copysign(self.rate * dt, delta)
+
+    def reached(self):
+        return abs(self.current - (self.target or AMBIENT)) < 1
+
+class GenericSimulator:
+    """ Generic dialect, Marlin-like but without any extras """
+    NAME = "generic"
+    RX_BUFFER_SIZE = 128
+    ## lines parsed from the receive buffer waiting to be processed
+    COMMAND_BUFFER = 4
+    PLANNER_SIZE = 16
+    BANNER = ['start']
+    FIRMWARE_NAME = "Generic (simulated)"
+    CAPABILITIES = []
+    BUSY = 'echo:busy: processing'
+    ## Serial port, bytes that do not fit the receive buffer are lost. With
+    ## flow control the host is held back instead, like USB does.
+    FLOW_CONTROL = False
+
+    def __init__(self, device, rx_queue, baudrate, cfg):
+        self.device = device
+        self.rx_queue = rx_queue
+        self.loop = device.gctx['loop']
+        self.speedup = cfg.getfloat('sim_speedup', fallback=1.)
+        self.rx_buffer_size = cfg.getint('sim_rx_buffer', fallback=self.RX_BUFFER_SIZE)
+        self.planner_size = cfg.getint('sim_planner', fallback=self.PLANNER_SIZE)
+        self.resend_rate = cfg.getfloat('sim_resend_rate', fallback=0.)
+        self.noise_rate = cfg.getfloat('sim_noise_rate', fallback=0.)
+        self.random = random.Random(cfg.get('sim_seed'))
+        ## seconds per byte on the wire, 8N1
+        self.byte_time = 10 / baudrate / self.speedup if baudrate else 0
+        self.link_in = self.link_out = 0.
+        self.rx = bytearray()
+        ## bytes the host was held back with
+        self.held = bytearray()
+        self.commands = deque()
+        self.command_ready = asyncio.Event()
+        ## finish times of planned moves, loop time
+        self.planner = deque()
+        self.state = gcodestate.ModalState()
+        self.heaters = {'T': Heater('T', 4.), 'B': Heater('B', 1.)}
+        self.heated = self.loop.time()
+        self.last_n = 0
+        ## set while a command executes
+        self.executing = False
+        self.halted = False
+        self.stats = {'overruns': 0, 'resends': 0, 'corrupted': 0}
+        self.reporters = {}
+        device.set_protocol(self)
+        self.tasks = [self.run(self.process())]
+        if cfg.getboolean('sim_wait', fallback=False):
+            self.tasks.append(self.run(self.idle_wait()))
+        for line in self.BANNER:
+            self.send(line)
+
+    def run(self, coro):
+        task = asyncio.ensure_future(coro)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, future):
+        """ A crashed firmware is a lost connection to the device """
+        if future.cancelled(): return
+        exc = future.exception()
+        if not exc: return
+        log.critical("Simulated firmware crashed: {}".format(exc))
+        log.critical(''.join(traceback.format_exception(type(exc), exc, exc.__traceback__)))
+        asyncio.ensure_future(self.device.disconnect())
+
+    ## transport side
+
+    def write(self, msg):
+        if self.halted: return
+        data = msg.encode()
+        if b'M112' in data:
+            ## emergency parser, acts before anything is buffered
+            self.kill()
+            return
+        if not self.byte_time:
+            self.receive(data)
+            return
+        now = self.loop.time()
+        self.link_in = max(now, self.link_in) + len(data) * self.byte_time
+        self.loop.call_at(self.link_in, self.receive, data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        log.info("Simulated connection closed")
+        for task in self.tasks + list(self.reporters.values()):
+            task.cancel()
+        asyncio.ensure_future(self.device.disconnect_done(None))
+
+    def send(self, line):
+        line += '\n'
+        if not self.byte_time:
+            self.rx_queue.put_nowait(line)
+            return
+        now = self.loop.time()
+        self.link_out = max(now, self.link_out) + len(line) * self.byte_time
+        self.loop.call_at(self.link_out, self.rx_queue.put_nowait, line)
+
+    def receive(self, data):
+        if self.halted: return
+        if self.FLOW_CONTROL:
+            self.held += data
+            self.parse()
+            return
+        room = self.rx_buffer_size - len(self.rx)
+        if len(data) > room:
+            self.stats['overruns'] += len(data) - room
+            data = data[:room]
+        self.rx += data
+        self.parse()
+
+    def parse(self):
+        """ Move complete lines from the receive buffer to the command buffer """
+        while len(self.commands) < self.COMMAND_BUFFER:
+            if self.held:
+                room = self.rx_buffer_size - len(self.rx)
+                self.rx += self.held[:room]
+                del self.held[:room]
+            idx = self.rx.find(b'\n')
+            if idx < 0: break
+            line = bytes(self.rx[:idx])
+            del self.rx[:idx+1]
+            if self.noise_rate and line and self.random.random() < self.noise_rate:
+                line = self.corrupt(line)
+            self.commands.append(line)
+            self.command_ready.set()
+
+    def corrupt(self, line):
+        self.stats['corrupted'] += 1
+        i = self.random.randrange(len(line))
+        return line[:i] + bytes([self.random.randrange(33, 127)]) + line[i+1:]
+
+    ## firmware side
+
+    def heat(self):
+        """ Bring the heaters up to date """
+        now = self.loop.time()
+        dt = (now - self.heated) * self.speedup
+        self.heated = now
+        for heater in self.heaters.values():
+            heater.step(dt)
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds / self.speedup)
+
+    async def process(self):
+        while True:
+            if not self.commands:
+                self.command_ready.clear()
+                await self.command_ready.wait()
+                continue
+            raw = self.commands.popleft()
+            self.parse()
+            line = raw.decode(errors='replace').strip()
+            if not line: continue
+            line = self.check_line(line)
+            if line is None: continue
+            self.executing = True
+            for response in await self.execute(line):
+                self.send(response)
+            self.executing = False
+
+    def check_line(self, line):
+        """ Handles line numbers and checksums. Returns the command or
+            None if the line was rejected. """
+        if not line.startswith('N'):
+            return line
+        m = NUMBERED.match(line)
+        if not m or flowcontrol.checksum(line[:line.rindex('*')]) != int(m.group(3)):
+            self.reject("checksum mismatch")
+            return None
+        n, command = int(m.group(1)), m.group(2).strip()
+        if command.upper().startswith('M110'):
+            self.last_n = int(gcodestate.words(command[4:]).get('N', n))
+            return command
+        if n != self.last_n + 1:
+            self.reject("Line Number is not Last Line Number+1")
+            return None
+        if self.resend_rate and self.random.random() < self.resend_rate:
+            self.reject("checksum mismatch")
+            return None
+        self.last_n = n
+        return command
+
+    def reject(self, reason):
+        self.stats['resends'] += 1
+        self.send("Error:{}, Last Line: {}".format(reason, self.last_n))
+        self.send("Resend: {}".format(self.last_n + 1))
+        self.send("ok")
+
+    async def execute(self, line):
+        """ Returns the response lines, ending with the ok """
+        cmd, _, args = line.partition(' ')
+        cmd = cmd.upper()
+        handler = self.COMMANDS.get(cmd)
+        if handler:
+            return await handler(self, args)
+        if cmd[:1] in 'GMT' and cmd[1:].isdigit():
+            self.state.process(line)
+            return ['ok']
+        return ['echo:Unknown command: "{}"'.format(line), 'ok']
+
+    async def move(self, args):
+        line = 'G1 ' + args
+        before = dict(self.state.position)
+        self.state.process(line)
+        after = self.state.position
+        distance = math.sqrt(sum((after[a] - before[a])**2 for a in 'XYZ'))
+        if not distance:
+            distance = abs(after['E'] - before['E'])
+        if not self.state.metric:
+            distance *= 25.4
+        feedrate = self.state.feedrate or DEFAULT_FEEDRATE
+        await self.plan(distance / feedrate * 60)
+        return ['ok']
+
+    def retire(self):
+        now = self.loop.time()
+        while self.planner and self.planner[0] <= now:
+            self.planner.popleft()
+
+    async def plan(self, seconds):
+        """ Add a move to the planner, waits for room like the firmware """
+        self.retire()
+        while len(self.planner) >= self.planner_size:
+            await asyncio.sleep(self.planner[0] - self.loop.time())
+            self.retire()
+        start = self.planner[-1] if self.planner else self.loop.time()
+        self.planner.append(start + seconds / self.speedup)
+
+    async def block(self, seconds):
+        """ Wait for all moves to finish, then for seconds more, sending
+            keepalives all the while """
+        end = self.planner[-1] if self.planner else self.loop.time()
+        end += seconds / self.speedup
+        while True:
+            remaining = end - self.loop.time()
+            if remaining <= 0: break
+            await asyncio.sleep(min(remaining, KEEPALIVE / self.speedup))
+            if self.BUSY and end - self.loop.time() > 0:
+                self.send(self.BUSY)
+        self.retire()
+
+    async def dwell(self, args):
+        d = gcodestate.words(args)
+        await self.block(d.get('S', d.get('P', 0) / 1000))
+        return ['ok']
+
+    async def home(self, args):
+        await self.block(HOMING_TIME)
+        for axis in 'XYZ':
+            self.state.position[axis] = 0.
+        return ['ok']
+
+    async def finish_moves(self, args):
+        await self.block(0)
+        return ['ok']
+
+    def set_target(self, heater, args):
+        d = gcodestate.words(args)
+        target = d.get('S', d.get('R'))
+        if target is not None:
+            self.heat()
+            self.heaters[heater].target = target
+
+    async def set_hotend(self, args):
+        self.set_target('T', args)
+        return ['ok']
+
+    async def set_bed(self, args):
+        self.set_target('B', args)
+        return ['ok']
+
+    async def wait_hotend(self, args):
+        self.set_target('T', args)
+        await self.heat_wait('T')
+        return ['ok']
+
+    async def wait_bed(self, args):
+        self.set_target('B', args)
+        await self.heat_wait('B')
+        return ['ok']
+
+    async def heat_wait(self, name):
+        """ Temperature reports once a second serve as keepalive """
+        heater = self.heaters[name]
+        while True:
+            self.heat()
+            if not heater.target or heater.reached(): return
+            self.send(self.temperatures())
+            await self.sleep(1)
+
+    def temperatures(self):
+        self.heat()
+        return ' '.join("{}:{:.2f} /{:.2f}".format(h.name, h.current, h.target)
+            for h in self.heaters.values())
+
+    async def report_temperatures(self, args):
+        return ['ok ' + self.temperatures()]
+
+    def position(self):
+        p = self.state.position
+        return "X:{:.2f} Y:{:.2f} Z:{:.2f} E:{:.2f}".format(p['X'], p['Y'], p['Z'], p['E'])
+
+    async def report_position(self, args):
+        return [self.position(), 'ok']
+
+    async def report_firmware(self, args):
+        lines = ["FIRMWARE_NAME:{} PROTOCOL_VERSION:1.0 MACHINE_TYPE:cncd simulator EXTRUDER_COUNT:1".format(self.FIRMWARE_NAME)]
+        lines += ["Cap:{}".format(cap) for cap in self.CAPABILITIES]
+        return lines + ['ok']
+
+    async def set_line_number(self, args):
+        ## numbered M110 is handled in check_line
+        d = gcodestate.words(args)
+        if 'N' in d:
+            self.last_n = int(d['N'])
+        return ['ok']
+
+    async def emergency(self, args):
+        self.kill()
+        return []
+
+    def kill(self):
+        self.halted = True
+        self.commands.clear()
+        self.planner.clear()
+        self.send("Error:Printer halted. kill() called!")
+
+    async def idle_wait(self):
+        while True:
+            await self.sleep(KEEPALIVE)
+            self.retire()
+            if not (self.executing or self.commands or self.planner or self.rx):
+                self.send('wait')
+
+    COMMANDS = {
+        'G0': move, 'G1': move, 'G2': move, 'G3': move,
+        'G00': move, 'G01': move, 'G02': move, 'G03': move,
+        'G4': dwell, 'G28': home, 'M400': finish_moves,
+        'M104': set_hotend, 'M109': wait_hotend,
+        'M140': set_bed, 'M190': wait_bed,
+        'M105': report_temperatures, 'M114': report_position,
+        'M115': report_firmware, 'M110': set_line_number,
+        'M112': emergency,
+    }
+
+class MarlinSimulator(GenericSimulator):
+    NAME = "marlin"
+    BANNER = ['start', 'echo:Marlin 2.1.2 (simulated)', 'echo:SD card ok']
+    FIRMWARE_NAME = "Marlin 2.1.2 (simulated)"
+    CAPABILITIES = ['SERIAL_XON_XOFF:0', 'EEPROM:0', 'AUTOREPORT_TEMP:1',
+        'AUTOREPORT_POS:1', 'BUSY_PROTOCOL:1', 'EMERGENCY_PARSER:1']
+
+    def temperatures(self):
+        return super().temperatures() + " @:0 B@:0"
+
+    async def autoreport(self, kind, args):
+        """ M155 and M154, report every S seconds. S0 stops. """
+        task = self.reporters.pop(kind, None)
+        if task: task.cancel()
+        interval = gcodestate.words(args).get('S', 0)
+        if interval > 0:
+            report = self.temperatures if kind == 'temperature' else self.position
+            self.reporters[kind] = self.run(self.reporter(report, interval))
+        return ['ok']
+
+    async def reporter(self, report, interval):
+        while True:
+            await self.sleep(interval)
+            self.send(' ' + report())
+
+    async def autoreport_temperatures(self, args):
+        return await self.autoreport('temperature', args)
+
+    async def autoreport_position(self, args):
+        return await self.autoreport('position', args)
+
+    COMMANDS = dict(GenericSimulator.COMMANDS,
+        M155=autoreport_temperatures, M154=autoreport_position)
+
+class SmoothieSimulator(GenericSimulator):
+    NAME = "smoothie"
+    RX_BUFFER_SIZE = 256
+    PLANNER_SIZE = 32
+    BANNER = ['Smoothie', 'ok']
+    FIRMWARE_NAME = "Smoothieware (simulated)"
+    ## Smoothie does not do keepalives
+    BUSY = None
+    ## talks USB, the 20 lines the host keeps in flight are larger than the
+    ## receive buffer
+    FLOW_CONTROL = True
+
+    def temperatures(self):
+        self.heat()
+        return ' '.join("{}:{:.1f} /{:.1f} @0".format(h.name, h.current, h.target)
+            for h in self.heaters.values())
+
+    def reject(self, reason):
+        self.stats['resends'] += 1
+        self.send("rs N{}".format(self.last_n + 1))
+        self.send("ok")
+
+    def kill(self):
+        self.halted = True
+        self.commands.clear()
+        self.held.clear()
+        self.planner.clear()
+        self.send("!!")
+
+SIMULATORS = {sim.NAME: sim for sim in (GenericSimulator, MarlinSimulator, SmoothieSimulator)}
+
+def simulate(device, rx_queue, dialect, baudrate, cfg):
+    """ Connect device to a simulated machine. Unknown dialects, like the
+        0 of dummy://0:0, get the generic simulator. """
+    sim = SIMULATORS.get(dialect.lower(), GenericSimulator)
+    log.info("Simulating {} firmware at {} baud".format(sim.NAME, baudrate or 'infinite'))
+    return sim(device, rx_queue, baudrate, cfg)
@@ -0,0 +1,17 @@
+import logging as log
+import re
+from collections import namedtuple
+
+## Telemetry is parsed once when it is received. A reading is stored and
+## sent to subscribers as is, in JSON it is the list
+## [sensor, current, target, timestamp]. target is None for sensors
+## without one, e.g. heater power (@).
+
+Reading = namedtuple('Reading', 'sensor current target timestamp')
+
+READING_PATTERN = re.compile(r"([^\s:]+):(-?\d+(?:\.\d+)?)(?: /(-?\d+(?:\.\d+)?))?")
+
+def readings(text, timestamp):
+    """ Readings of a temperature report like 'T:210.0 /210.0 B:60.0 /60.0' """
+    return [Reading(sensor, float(current), float(target) if target else None, timestamp)
+        for sensor, current, target in READING_PATTERN.findall(text)]
@@ -0,0 +1,123 @@
+import logging as log
+from array import array
+from fnmatch import fnmatchcase
+
+## Numeric history in fixed size ring buffers. A series is kept in several
+## tiers of increasing step, every sample is added to all of them. A slot
+## holds the mean of the samples in its step, so memory per series is fixed:
+## 20 bytes per slot, 0.45 MB for the default tiers.
+
+## (step in seconds, slots): 1 s for an hour, 10 s for a day, 1 min for a week
+TIERS = ((1, 3600), (10, 8640), (60, 10080))
+## a query never returns more values than this, the step is raised instead
+MAX_POINTS = 5000
+
+class Tier:
+    """ Ring buffer of means over step seconds """
+    def __init__(self, step, slots):
+        self.step = step
+        self.slots = slots
+        ## number of the step a slot belongs to, -1 when empty
+        self.buckets = array('q', [-1]) * slots
+        self.means = array('d', [0.]) * slots
+        self.counts = array('i', [0]) * slots
+
+    def add(self, t, value):
+        bucket = int(t // self.step)
+        i = bucket % self.slots
+        if self.buckets[i] != bucket:
+            self.buckets[i] = bucket
+            self.means[i] = value
+            self.counts[i] = 1
+        else:
+            n = self.counts[i] + 1
+            self.means[i] += (value - self.means[i]) / n
+            self.counts[i] = n
+
+    def oldest(self, now):
+        """ Start of the oldest step still kept """
+        return (int(now // self.step) - self.slots + 1) * self.step
+
+    def values(self, first, last):
+        """ Means of buckets first up to and including last, None where
+            nothing was added """
+        out = []
+        for bucket in range(first, last + 1):
+            i = bucket % self.slots
+            out.append(self.means[i] if self.buckets[i] == bucket else None)
+        return out
+
+def downsample(values, factor):
+    """ Mean of every factor values, skipping gaps """
+    out = []
+    for i in range(0, len(values), factor):
+        group = [v for v in values[i:i+factor] if v is not None]
+        out.append(sum(group) / len(group) if group else None)
+    return out
+
+class Series:
+    def __init__(self, tiers):
+        self.tiers = [Tier(step, slots) for step, slots in sorted(tiers)]
+
+    def add(self, t, value):
+        for tier in self.tiers:
+            tier.add(t, value)
+
+    def query(self, start, stop, step, now):
+        """ Values from start to stop, step seconds apart or more. Of the
+            tiers still covering start the coarsest not coarser than step
+            is used. Returns (time of the first value, step, values). """
+        ## a tier missing only the first step still counts
+        covering = [t for t in self.tiers if t.oldest(now) <= start + t.step] or self.tiers[-1:]
+        tier = covering[0]
+        for t in covering:
+            if t.step <= step:
+                tier = t
+        first = int(max(start, tier.oldest(now)) // tier.step)
+        last = int(min(stop, now) // tier.step)
+        factor = max(1, int(step // tier.step))
+        count = last - first + 1
+        if count <= 0:
+            return first * tier.step, tier.step * factor, []
+        factor = max(factor, -(-count // MAX_POINTS))
+        ## align to the downsampled step, same buckets every query
+        first -= first % factor
+        values = tier.values(first, last)
+        if factor > 1:
+            values = downsample(values, factor)
+        return first * tier.step, tier.step * factor, values
+
+class TimeSeriesStore:
+    """ Series per device and key. At most max_series per device, later
+        keys are not recorded. """
+    def __init__(self, tiers=TIERS, max_series=32, patterns=('*',)):
+        self.tiers = tiers
+        self.max_series = max_series
+        self.patterns = patterns
+        self.series = {}
+        ## keys that did not match or did not fit
+        self.ignored = set()
+
+    def add(self, device, key, t, value):
+        series = self.series.get((device, key))
+        if not series:
+            if (device, key) in self.ignored: return
+            if not self.wanted(device, key):
+                self.ignored.add((device, key))
+                return
+            series = self.series[(device, key)] = Series(self.tiers)
+        series.add(t, value)
+
+    def wanted(self, device, key):
+        if not any(fnmatchcase(key, pattern) for pattern in self.patterns):
+            return False
+        if len(self.keys(device)) >= self.max_series:
+            log.warning("History of '{}' is full, not recording '{}'".format(device, key))
+            return False
+        return True
+
+    def keys(self, device):
+        return sorted(key for dev, key in self.series if dev == device)
+
+    def get(self, device, key):
+        return self.series.get((device, key))